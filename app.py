@@ -1,32 +1,109 @@
-from flask import Flask, render_template, request, jsonify
-from flask_mail import Mail, Message
+from flask import Flask, render_template, request, jsonify, make_response
+from flask_mail import Mail
+from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from datetime import datetime, timedelta
 from functools import wraps
 from flask import session, redirect, url_for, flash
 import os
 from werkzeug.utils import secure_filename
 import random
 import re
+import click
+from sharding import ShardRouter
+from notifications import MailOutbox
+from currency import ExchangeRates, MissingRateError
+from security import PasswordHasher, HasherBusy, TokenBucketLimiter
+from idempotency import IdempotencyStore, DeferredCommitSession, digest
+from consistency import ConsistencyChecker
+from migrations import ColumnUpgrade, IndexUpgrade, upgrade_schema
 
 app = Flask(__name__)
 app.secret_key = "change_this_to_a_random_secret_in_production"
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('SHAREPAY_DATABASE_URI', 'sqlite:///app.db')
+# Sharding configuration: with SHARD_COUNT > 0, Expense and ExpenseSplit rows
+# live in one of SHARD_COUNT databases chosen by group_id instead of app.db.
+# SHARD_DATABASE_URI is a template with a {shard} placeholder; when unset the
+# shards are created next to app.db in the instance folder.
+app.config['SHARD_COUNT'] = int(os.environ.get('SHAREPAY_SHARD_COUNT', 0))
+app.config['SHARD_DATABASE_URI'] = os.environ.get('SHAREPAY_SHARD_DATABASE_URI')
 # Upload configuration
 UPLOAD_FOLDER = os.path.join('static', 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf'}
 
+# Currency configuration: groups keep balances in their base currency and
+# expenses are converted through RATE_PIVOT_CURRENCY when they are written.
+DEFAULT_CURRENCY = 'USD'
+app.config['RATE_PIVOT_CURRENCY'] = 'USD'
+app.config['RATE_CACHE_SIZE'] = 4096
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-db = SQLAlchemy(app)
+def valid_currency(code):
+    # ISO 4217 style code, already upper-cased by the caller
+    return re.fullmatch(r'[A-Z]{3}', code) is not None
+
+# Commits can be held back until a request ends, see the idempotent decorator
+db = SQLAlchemy(app, session_options={'class_': DeferredCommitSession})
 
 # Mail configuration (simulation)
 app.config['TESTING'] = True # This will prevent emails from being sent
+app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', '127.0.0.1')
+app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 25))
+# Set MAIL_SUPPRESS_SEND=0 to deliver through MAIL_SERVER despite TESTING
+app.config['MAIL_SUPPRESS_SEND'] = os.environ.get('MAIL_SUPPRESS_SEND', '1') != '0'
+app.config['MAIL_DEFAULT_SENDER'] = 'sharepay@no-reply.com'
 mail = Mail(app)
 
+# Outbox sender: messages are queued in the database and delivered in
+# batches by a background thread. Failed sends are retried after
+# MAIL_RETRY_BACKOFF seconds, doubling on every attempt.
+app.config['MAIL_BATCH_SIZE'] = 50
+app.config['MAIL_MAX_ATTEMPTS'] = 5
+app.config['MAIL_RETRY_BACKOFF'] = 30
+app.config['MAIL_FLUSH_INTERVAL'] = 5
+# A sender holds the messages it picked for this long before others may retry them
+app.config['MAIL_CLAIM_LEASE'] = 300
+# Expense activity is collected per user and mailed as one digest this often
+app.config['NOTIFICATION_DIGEST_INTERVAL'] = 3600
+
+# Password hashing: bcrypt work factor, and the pool that runs it. Changing
+# BCRYPT_LOG_ROUNDS rehashes each password on that user's next login.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('SHAREPAY_BCRYPT_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = min(4, os.cpu_count() or 1)
+app.config['PASSWORD_HASH_QUEUE'] = 16
+bcrypt = Bcrypt(app)
+hasher = PasswordHasher(bcrypt, app)
+
+# Login throttling: token buckets per client IP and per account, checked
+# before any hashing. BURST attempts at once, refilled at RATE per second.
+app.config['LOGIN_IP_BURST'] = 20
+app.config['LOGIN_IP_RATE'] = 1.0
+app.config['LOGIN_ACCOUNT_BURST'] = 5
+app.config['LOGIN_ACCOUNT_RATE'] = 0.1
+login_ip_limiter = TokenBucketLimiter(app.config['LOGIN_IP_RATE'], app.config['LOGIN_IP_BURST'])
+login_account_limiter = TokenBucketLimiter(app.config['LOGIN_ACCOUNT_RATE'], app.config['LOGIN_ACCOUNT_BURST'])
+
+# Idempotency keys: responses to mutating requests sent with an
+# Idempotency-Key header are kept this many seconds and replayed on retry.
+# Expired keys are purged at most once per IDEMPOTENCY_PURGE_INTERVAL.
+app.config['IDEMPOTENCY_KEY_TTL'] = 24 * 3600
+app.config['IDEMPOTENCY_PURGE_INTERVAL'] = 600
+# A request still running after this many seconds is presumed dead, and a
+# retry with its key runs the handler again
+app.config['IDEMPOTENCY_CLAIM_LEASE'] = 60
+
+# Consistency checker: candidates are checked CONSISTENCY_BATCH_SIZE expenses
+# per transaction with CONSISTENCY_PAUSE seconds between batches. Each scan
+# re-covers the last CONSISTENCY_OVERLAP seconds of the previous one.
+app.config['CONSISTENCY_BATCH_SIZE'] = 500
+app.config['CONSISTENCY_PAUSE'] = 0.05
+app.config['CONSISTENCY_OVERLAP'] = 60
+app.config['CONSISTENCY_CHECK_INTERVAL'] = 600
+
 
 
 # Association table for many-to-many relationship between user and groups
@@ -46,7 +123,7 @@ class User(db.Model):
         return f'<User {self.username}>'
     
     def reset_password(self, new_password):
-        self.password = new_password
+        self.password = hasher.hash(new_password)
         db.session.commit()
 
 # Define Group Model
@@ -54,6 +131,10 @@ class Group(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), unique=True, nullable=False)
     tag = db.Column(db.String(200), unique=True, nullable=True)
+    # Currency the group's balances are kept in
+    base_currency = db.Column(db.String(3), nullable=False, default=DEFAULT_CURRENCY)
+    # Bumped on join/leave so the consistency checker rechecks the group's splits
+    members_changed_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     members = db.relationship('User', secondary=members, lazy='subquery', backref=db.backref('groups', lazy=True))
 
     def __repr__(self):
@@ -64,14 +145,18 @@ class Expense(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     description = db.Column(db.String(500), nullable = False)
     amount = db.Column(db.Float, nullable=False)
+    currency = db.Column(db.String(3), nullable=False, default=DEFAULT_CURRENCY)
+    # amount converted to the group's base currency at write time
+    base_amount = db.Column(db.Float, nullable=True)
     date = db.Column(db.DateTime, default=datetime.utcnow)
     location = db.Column(db.String(300), nullable=True)
     receipt_image = db.Column(db.String(300), nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     # The user who paid the expense
     payer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     # Linking it to the group
-    group_id = db.Column(db.Integer, db.ForeignKey('group.id'), nullable=False)
+    group_id = db.Column(db.Integer, db.ForeignKey('group.id'), nullable=False, index=True)
 
 
     def __repr__(self):
@@ -79,16 +164,310 @@ class Expense(db.Model):
 
 class ExpenseSplit(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    expense_id = db.Column(db.Integer, db.ForeignKey('expense.id'), nullable=False)
+    expense_id = db.Column(db.Integer, db.ForeignKey('expense.id'), nullable=False, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     amount = db.Column(db.Float, nullable=False)
+    # Share in the group's base currency, stored so balances never convert on read
+    base_amount = db.Column(db.Float, nullable=True)
     is_settled = db.Column(db.Boolean, default=False)
     receipt_image = db.Column(db.String(300), nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     def __repr__(self):
         return f'<ExpenseSplit for User {self.user_id} - Amount: {self.amount}>'
 
 
+# How far each database has been scanned by the consistency checker
+class ConsistencyCheckpoint(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    checked_until = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<ConsistencyCheckpoint {self.name} {self.checked_until}>'
+
+
+# Stored response for an Idempotency-Key; status_code is NULL while the
+# first request with that key is still running
+class IdempotencyKey(db.Model):
+    # Truncated sha256 of (user, key) and of the request, see idempotency.digest
+    key = db.Column(db.LargeBinary(16), primary_key=True)
+    fingerprint = db.Column(db.LargeBinary(16), nullable=False)
+    status_code = db.Column(db.Integer, nullable=True)
+    location = db.Column(db.String(500), nullable=True)
+    content_type = db.Column(db.String(100), nullable=True)
+    body = db.Column(db.LargeBinary, nullable=True)
+    # When the running request took the key; its claim lapses after IDEMPOTENCY_CLAIM_LEASE
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<IdempotencyKey {self.key.hex()} - {self.status_code}>'
+
+
+idempotency_store = IdempotencyStore(db, IdempotencyKey)
+
+
+# Units of `currency` per one unit of RATE_PIVOT_CURRENCY on a given day
+class ExchangeRate(db.Model):
+    __table_args__ = (db.UniqueConstraint('currency', 'date'),)
+    id = db.Column(db.Integer, primary_key=True)
+    currency = db.Column(db.String(3), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    rate = db.Column(db.Float, nullable=False)
+    # Newest value tells ExchangeRates that its cache is stale
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f'<ExchangeRate {self.currency} {self.date} {self.rate}>'
+
+
+rates = ExchangeRates(db, ExchangeRate, app.config['RATE_PIVOT_CURRENCY'], app.config['RATE_CACHE_SIZE'])
+
+
+# Mail waiting to be delivered by the background sender
+class OutboxMessage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(200), nullable=False)
+    subject = db.Column(db.String(300), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=True, index=True)
+    last_error = db.Column(db.String(500), nullable=True)
+    # Set while a sender holds the message, see MailOutbox.claim_batch
+    locked_until = db.Column(db.DateTime, nullable=True)
+    locked_by = db.Column(db.String(32), nullable=True, index=True)
+
+    def __repr__(self):
+        return f'<OutboxMessage to {self.recipient} - {self.subject}>'
+
+
+# Activity a user should hear about; coalesced into periodic digest mails
+class NotificationEvent(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    text = db.Column(db.String(500), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    digested = db.Column(db.Boolean, default=False, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<NotificationEvent for User {self.user_id}>'
+
+
+outbox = MailOutbox(db, mail, OutboxMessage, NotificationEvent, User)
+
+
+# Explicit shard placement for groups moved by the rebalancing tool.
+# Groups without a row here live on shard group_id % SHARD_COUNT.
+class GroupShard(db.Model):
+    group_id = db.Column(db.Integer, db.ForeignKey('group.id'), primary_key=True)
+    shard = db.Column(db.Integer, nullable=False)
+    # Set while move_group_to_shard runs; writes for the group are refused
+    moving = db.Column(db.Boolean, default=False, nullable=False)
+
+    def __repr__(self):
+        return f'<GroupShard {self.group_id} -> {self.shard}>'
+
+
+shard_router = ShardRouter(db, [Expense, ExpenseSplit], GroupShard, app)
+consistency_checker = ConsistencyChecker(db, shard_router, Expense, ExpenseSplit, Group, members, ConsistencyCheckpoint)
+
+# Columns added to tables after they first shipped. db.create_all() never
+# alters an existing table, so upgrade_database() adds these to app.db and
+# every shard and backfills rows written by older versions.
+# Current UTC time in the format SQLAlchemy stores DateTime columns in on SQLite
+NOW_SQL = "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
+SCHEMA_UPGRADES = [
+    ColumnUpgrade('group', 'base_currency', "VARCHAR(3) NOT NULL DEFAULT 'USD'"),
+    ColumnUpgrade('expense', 'currency', "VARCHAR(3) NOT NULL DEFAULT 'USD'"),
+    # Older expenses and groups are all in USD, so nothing needs converting
+    ColumnUpgrade('expense', 'base_amount', 'FLOAT', backfill='amount'),
+    ColumnUpgrade('expense_split', 'base_amount', 'FLOAT', backfill='amount'),
+    ColumnUpgrade('group_shard', 'moving', 'BOOLEAN NOT NULL DEFAULT 0'),
+    ColumnUpgrade('outbox_message', 'locked_until', 'DATETIME'),
+    ColumnUpgrade('outbox_message', 'locked_by', 'VARCHAR(32)', index=True),
+    ColumnUpgrade('idempotency_key', 'claimed_at', 'DATETIME'),
+    ColumnUpgrade('exchange_rate', 'updated_at', 'DATETIME', backfill=NOW_SQL, index=True),
+    # Stamp existing rows as just changed so the next incremental check covers them
+    ColumnUpgrade('group', 'members_changed_at', 'DATETIME', backfill=NOW_SQL, index=True),
+    ColumnUpgrade('expense', 'updated_at', 'DATETIME', backfill=NOW_SQL, index=True),
+    ColumnUpgrade('expense_split', 'updated_at', 'DATETIME', backfill=NOW_SQL, index=True),
+    # Without these every consistency batch scans the whole split table
+    IndexUpgrade('expense', 'group_id'),
+    IndexUpgrade('expense_split', 'expense_id'),
+]
+
+
+def upgrade_database():
+    """Create missing tables and columns everywhere; returns what was added."""
+    db.create_all()
+    shard_router.create_all()
+    added = upgrade_schema(db.engine, SCHEMA_UPGRADES)
+    for shard, engine in enumerate(shard_router.engines):
+        added += [f'shard {shard}: {name}' for name in upgrade_schema(engine, SCHEMA_UPGRADES)]
+    return added
+
+
+# Returned when ShardRouter.commit refuses a write because the group is
+# being moved between shards; the client should simply retry
+GROUP_MOVING_RESPONSE = ('This group is being moved between databases, please try again.', 503)
+
+
+def shard_session_from_form():
+    # Expense and split ids are only unique within one shard, so when sharding
+    # is enabled the form must also name the owning group.
+    group_id = request.form.get('group_id')
+    if not shard_router.enabled:
+        return db.session
+    try:
+        return shard_router.session_for(int(group_id))
+    except (TypeError, ValueError):
+        return None
+
+
+def move_group_to_shard(group_id, dest):
+    """Move every expense and split of a group to shard dest.
+
+    Safe while the app is serving requests: the group is flagged as moving
+    and the source shard is write-locked for the whole copy, and writers
+    re-check the placement under the shard lock before committing (see
+    ShardRouter.commit), so no write can land on the source shard once the
+    copy has started. Ids are reassigned on the destination shard. A failed
+    move leaves the group on the source shard and can simply be rerun.
+    """
+    source = shard_router.shard_for(group_id)
+    if source == dest:
+        return 0
+    src_session = shard_router.shard_session(source)
+    dst_session = shard_router.shard_session(dest)
+
+    # Anything already on dest is a leftover from an earlier failed move
+    stale = db.select(Expense.id).where(Expense.group_id == group_id)
+    dst_session.execute(db.delete(ExpenseSplit).where(ExpenseSplit.expense_id.in_(stale)))
+    dst_session.execute(db.delete(Expense).where(Expense.group_id == group_id))
+    dst_session.commit()
+
+    # From here on, writers for this group roll back and ask for a retry
+    db.session.merge(GroupShard(group_id=group_id, shard=source, moving=True))
+    db.session.commit()
+    try:
+        # Wait for in-flight writers on the source shard and keep new ones out
+        src_session.connection().exec_driver_sql('BEGIN IMMEDIATE')
+
+        expenses = src_session.execute(
+            db.select(Expense).where(Expense.group_id == group_id)
+        ).scalars().all()
+        for expense in expenses:
+            copy = Expense(
+                description=expense.description,
+                amount=expense.amount,
+                currency=expense.currency,
+                base_amount=expense.base_amount,
+                date=expense.date,
+                location=expense.location,
+                receipt_image=expense.receipt_image,
+                payer_id=expense.payer_id,
+                group_id=expense.group_id
+            )
+            dst_session.add(copy)
+            dst_session.flush()
+            splits = src_session.execute(
+                db.select(ExpenseSplit).where(ExpenseSplit.expense_id == expense.id)
+            ).scalars()
+            for s in splits:
+                dst_session.add(ExpenseSplit(
+                    expense_id=copy.id,
+                    user_id=s.user_id,
+                    amount=s.amount,
+                    base_amount=s.base_amount,
+                    is_settled=s.is_settled,
+                    receipt_image=s.receipt_image
+                ))
+        dst_session.commit()
+
+        db.session.merge(GroupShard(group_id=group_id, shard=dest, moving=False))
+        db.session.commit()
+
+        src_session.execute(db.delete(ExpenseSplit).where(ExpenseSplit.expense_id.in_([e.id for e in expenses])))
+        src_session.execute(db.delete(Expense).where(Expense.group_id == group_id))
+        src_session.commit()
+    except Exception:
+        src_session.rollback()
+        dst_session.rollback()
+        db.session.rollback()
+        # Still on the source shard; reopen it for writes
+        placement = db.session.get(GroupShard, group_id, populate_existing=True)
+        if placement.shard == source:
+            placement.moving = False
+            db.session.commit()
+        raise
+    return len(expenses)
+
+
+@app.cli.command('move-group')
+@click.argument('group_id', type=int)
+@click.argument('shard', type=int)
+def move_group_command(group_id, shard):
+    """Move a group's expenses and splits to another shard."""
+    if not shard_router.enabled:
+        raise click.ClickException('Sharding is disabled (SHARD_COUNT is 0).')
+    if not 0 <= shard < len(shard_router.engines):
+        raise click.ClickException(f'Shard must be between 0 and {len(shard_router.engines) - 1}.')
+    if not Group.query.get(group_id):
+        raise click.ClickException('Group not found.')
+    moved = move_group_to_shard(group_id, shard)
+    click.echo(f'Moved {moved} expenses of group {group_id} to shard {shard}.')
+
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Bring app.db and the shards up to the current schema."""
+    for name in upgrade_database():
+        click.echo(f'Added {name}')
+    click.echo('Database schema is up to date.')
+
+
+@app.cli.command('import-rates')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_rates_command(path):
+    """Bulk load exchange rates from a date,currency,rate CSV file."""
+    count = rates.import_csv(path)
+    click.echo(f'Imported {count} exchange rates.')
+
+
+@app.cli.command('purge-idempotency-keys')
+def purge_idempotency_keys_command():
+    """Delete expired Idempotency-Key records."""
+    click.echo(f'Purged {idempotency_store.purge_expired()} expired keys.')
+
+
+@app.cli.command('check-consistency')
+@click.option('--repair', is_flag=True, help='Fix violations on expenses without settled splits.')
+@click.option('--full', is_flag=True, help='Check every expense, not just those changed since the last run.')
+@click.option('--loop', is_flag=True, help='Keep running every CONSISTENCY_CHECK_INTERVAL seconds at low priority; with --full every pass is a full check.')
+def check_consistency_command(repair, full, loop):
+    """Verify split totals and membership of expense splits."""
+    if loop:
+        consistency_checker.run_forever(app, repair=repair, full=full)
+        return
+    violations = consistency_checker.run(app, repair=repair, full=full)
+    for v in violations:
+        click.echo(f'{v.kind}: expense={v.expense_id} split={v.split_id} {v.detail}')
+    click.echo(f'{len(violations)} violations found.')
+
+
+@app.cli.command('send-mail')
+@click.option('--once', is_flag=True, help='Flush the outbox once and exit.')
+def send_mail_command(once):
+    """Run the outbox sender in the foreground."""
+    if once:
+        sent = outbox.run_once(app)
+        click.echo(f'Sent {sent} messages.')
+    else:
+        outbox.run_forever(app)
+
+
 # This is the route to the homepage
 @app.route('/')
 def index():
@@ -108,6 +487,54 @@ def login_required(f):
     return decorated_function
 
 
+def idempotent(f):
+    # Retries carrying the same Idempotency-Key get the first response back
+    # instead of running the handler (and its inserts) again
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return f(*args, **kwargs)
+        if len(key) > 255:
+            return 'Idempotency-Key too long', 400
+
+        idempotency_store.purge_expired(app.config['IDEMPOTENCY_PURGE_INTERVAL'])
+        # The fingerprint is a fast hash, so passwords are left out of it
+        form = sorted((name, value) for name, value in request.form.items(multi=True) if name != 'password')
+        files = sorted((name, file.filename) for name, file in request.files.items(multi=True))
+        fingerprint = digest(request.endpoint, form, files)
+        # Keys belong to the logged-in user. Anonymous callers (register,
+        # forget_password, ...) are told apart by address: a retry whose first
+        # response was lost never received a session cookie to send back.
+        scope = session.get('user_id') or f'anonymous {request.remote_addr}'
+        ttl = timedelta(seconds=app.config['IDEMPOTENCY_KEY_TTL'])
+        lease = timedelta(seconds=app.config['IDEMPOTENCY_CLAIM_LEASE'])
+        row_key, row = idempotency_store.claim(scope, key, fingerprint, ttl, lease)
+        if row is not None:
+            if row.fingerprint != fingerprint:
+                return 'Idempotency-Key was already used for a different request', 422
+            if row.status_code is None:
+                return 'A request with this Idempotency-Key is still in progress', 409
+            return idempotency_store.replay(row)
+
+        if not shard_router.enabled:
+            # Everything lives in app.db, so the handler's writes and the
+            # stored response can commit as one transaction
+            idempotency_store.defer_commits()
+        try:
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            idempotency_store.release(row_key)
+            raise
+        if response.status_code >= 500:
+            # Server-side failures are worth retrying for real
+            idempotency_store.release(row_key)
+        else:
+            idempotency_store.complete(row_key, response)
+        return response
+    return decorated_function
+
+
 @app.route('/users')
 def user_list():
     users = db.session.execute(db.select(User).order_by(User.username)).scalars()
@@ -120,12 +547,19 @@ def user_list():
 
 # This is the route to register a new user
 @app.route('/register', methods=['POST'])
+@idempotent
 def register():
     if request.method == "POST":
         username = request.form.get('username')
         email = request.form.get('email')
         password = request.form.get('password')
 
+    if not username or not password:
+        return 'Username and password are required!', 400
+    # Registration hashes too, so it shares the per-IP budget with login
+    if not login_ip_limiter.allow(request.remote_addr):
+        return 'Too many attempts, please try again later.', 429
+
     # Create a new database entry
     existing_user = User.query.filter_by(username=username).first()
     existing_email = User.query.filter_by(email=email).first()
@@ -133,7 +567,11 @@ def register():
     if existing_user or existing_email:
         return 'User or Email already exists!'
 
-    new_user = User(username=username, email=email, password=password)
+    try:
+        hashed = hasher.hash(password)
+    except HasherBusy:
+        return 'Server busy, please try again.', 503
+    new_user = User(username=username, email=email, password=hashed)
     db.session.add(new_user)
     db.session.commit()
     # Log the user in by setting the session
@@ -149,8 +587,26 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
 
-    user = User.query.filter_by(username=username, password=password).first()
-    if user:
+    if not username or not password:
+        return 'Invalid credentials!'
+    # Reject bursts before doing any password hashing
+    if not login_ip_limiter.allow(request.remote_addr) or not login_account_limiter.allow(username.lower()):
+        return 'Too many login attempts, please try again later.', 429
+
+    user = User.query.filter_by(username=username).first()
+    try:
+        valid = hasher.verify(user.password if user else None, password)
+    except HasherBusy:
+        return 'Server busy, please try again.', 503
+    if valid:
+        if hasher.needs_rehash(user.password):
+            # Work factor changed (or legacy plaintext): upgrade the stored hash
+            try:
+                user.password = hasher.hash(password)
+                db.session.commit()
+            except HasherBusy:
+                # Not worth failing the login over; retried on the next one
+                pass
         # Set session and redirect to dashboard
         session['user_id'] = user.id
         session['username'] = user.username
@@ -161,28 +617,19 @@ def login():
 
 # This forget password route is not currently working
 @app.route('/forget_password', methods=['POST'])
+@idempotent
 def forget_password():
     if request.method == "POST":
         email = request.form.get('email')
 
     user = User.query.filter_by(email=email).first()
     if user:
-        msg = Message(
-            'Hello',
-            sender = 'sharepay@no-reply.com',
-            recipients = [email]
-        )
-        msg.body = 'Click the link to reset your password: http://example.com/reset_password'
-        
-        # In testing mode, the email is not sent but captured.
-        # We can access it to show the content.
-        with mail.record_messages() as outbox:
-            mail.send(msg)
-            # Return the content of the email body
-            if outbox:
-                return f"EMAIL: {outbox[0].body}"
-            else:
-                return "Failed to simulate email."
+        body = 'Click the link to reset your password: http://example.com/reset_password'
+        # Queue the email for the background sender instead of sending inline
+        outbox.enqueue(email, 'Hello', body)
+        db.session.commit()
+        # Return the content of the email body
+        return f"EMAIL: {body}"
 
     else:
         return 'Email not found!'
@@ -210,11 +657,6 @@ def dashboard():
     # Groups the user belongs to
     groups = user.groups if user else []
 
-    # Outstanding splits for the user (is_settled = False)
-    splits = db.session.execute(
-        db.select(ExpenseSplit).where(ExpenseSplit.user_id == user_id, ExpenseSplit.is_settled == False)
-    ).scalars()
-
     # Build a structure for template
     groups_list = []
     for g in groups:
@@ -222,46 +664,78 @@ def dashboard():
             'id': g.id,
             'name': g.name,
             'tag': g.tag,
+            'base_currency': g.base_currency,
+            'balance': 0.0,
             'members': [{'id': m.id, 'username': m.username, 'email': m.email} for m in g.members]
         })
+    group_ids = [g['id'] for g in groups_list]
 
-    splits_list = []
-    for s in splits:
-        expense = Expense.query.get(s.expense_id)
-        payer = User.query.get(expense.payer_id) if expense else None
-        splits_list.append({
-            'split_id': s.id,
-            'expense_description': expense.description if expense else '',
-            'amount': s.amount,
-            'group_id': expense.group_id if expense else None,
-            'payer': payer.username if payer else None,
-            'is_settled': s.is_settled
-        })
+    # Splits and expenses may live on any shard, so query every shard in
+    # parallel and merge. Each split is fetched together with its expense
+    # because both rows always live on the same shard.
+    def load_splits(sess):
+        return sess.execute(
+            db.select(ExpenseSplit, Expense)
+            .outerjoin(Expense, Expense.id == ExpenseSplit.expense_id)
+            .where(ExpenseSplit.user_id == user_id)
+            .order_by(ExpenseSplit.id)
+        ).all()
+
+    # Unsettled totals between the user and others, per group, summed from the
+    # base-currency amounts stored when each expense was written
+    def load_balances(sess):
+        return sess.execute(
+            db.select(Expense.group_id, Expense.payer_id, db.func.sum(db.func.coalesce(ExpenseSplit.base_amount, ExpenseSplit.amount)))
+            .join(Expense, Expense.id == ExpenseSplit.expense_id)
+            .where(Expense.group_id.in_(group_ids), ExpenseSplit.is_settled == False,
+                   db.or_(Expense.payer_id == user_id, ExpenseSplit.user_id == user_id))
+            .group_by(Expense.group_id, Expense.payer_id)
+        ).all()
+
+    def load_expenses(sess):
+        return sess.execute(
+            db.select(Expense).where(Expense.group_id.in_(group_ids)).order_by(Expense.date.desc())
+        ).scalars()
 
+    split_rows = shard_router.fan_out(load_splits, lambda row: row[1].group_id if row[1] else None)
+
+    # Outstanding splits for the user (is_settled = False)
+    splits_list = []
     # Settled splits (these will be hidden by default in the UI and revealed by a button)
     settled_splits_list = []
-    settled_splits = db.session.execute(
-        db.select(ExpenseSplit).where(ExpenseSplit.user_id == user_id, ExpenseSplit.is_settled == True)
-    ).scalars()
-    for s in settled_splits:
-        expense = Expense.query.get(s.expense_id)
+    for s, expense in split_rows:
         payer = User.query.get(expense.payer_id) if expense else None
-        settled_splits_list.append({
-            'split_id': s.id,
-            'expense_description': expense.description if expense else '',
-            'amount': s.amount,
-            'group_id': expense.group_id if expense else None,
-            'payer': payer.username if payer else None,
-            'date': expense.date if expense else None
-        })
+        if s.is_settled:
+            settled_splits_list.append({
+                'split_id': s.id,
+                'expense_description': expense.description if expense else '',
+                'amount': s.amount,
+                'currency': expense.currency if expense else DEFAULT_CURRENCY,
+                'group_id': expense.group_id if expense else None,
+                'payer': payer.username if payer else None,
+                'date': expense.date if expense else None
+            })
+        else:
+            splits_list.append({
+                'split_id': s.id,
+                'expense_description': expense.description if expense else '',
+                'amount': s.amount,
+                'currency': expense.currency if expense else DEFAULT_CURRENCY,
+                'group_id': expense.group_id if expense else None,
+                'payer': payer.username if payer else None,
+                'is_settled': s.is_settled
+            })
 
     # Also fetch recent expenses for the groups the user belongs to
-    group_ids = [g['id'] for g in groups_list]
     expenses_list = []
     if group_ids:
-        expenses = db.session.execute(
-            db.select(Expense).where(Expense.group_id.in_(group_ids)).order_by(Expense.date.desc())
-        ).scalars()
+        # Positive balance: others owe the user; negative: the user owes
+        balances = {g['id']: g for g in groups_list}
+        for group_id, payer_id, total in shard_router.fan_out(load_balances, lambda row: row[0]):
+            balances[group_id]['balance'] += total if payer_id == user_id else -total
+
+        expenses = shard_router.fan_out(load_expenses, lambda e: e.group_id)
+        expenses.sort(key=lambda e: e.date or datetime.min, reverse=True)
         for e in expenses:
             payer = User.query.get(e.payer_id)
             expenses_list.append({
@@ -269,6 +743,7 @@ def dashboard():
                 'description': e.description,
                 'location': e.location if hasattr(e, 'location') else None,
                 'amount': e.amount,
+                'currency': e.currency,
                 'date': e.date,
                 'group_id': e.group_id,
                 'payer_id': e.payer_id,
@@ -281,11 +756,15 @@ def dashboard():
 
 @app.route('/edit_expense', methods=['POST'])
 @login_required
+@idempotent
 def edit_expense():
     expense_id = request.form.get('expense_id')
     if not expense_id:
         return 'expense_id required', 400
-    expense = Expense.query.get(expense_id)
+    sess = shard_session_from_form()
+    if sess is None:
+        return 'group_id required', 400
+    expense = sess.get(Expense, expense_id)
     if not expense:
         return 'Expense not found', 404
     # Only payer can edit
@@ -293,7 +772,9 @@ def edit_expense():
         return 'Not authorized to edit this expense', 403
 
     # Prevent editing if any split is already settled
-    settled_any = ExpenseSplit.query.filter_by(expense_id=expense.id, is_settled=True).first()
+    settled_any = sess.execute(
+        db.select(ExpenseSplit).filter_by(expense_id=expense.id, is_settled=True)
+    ).scalars().first()
     if settled_any:
         flash('Cannot edit this expense because one or more splits are already settled.')
         return redirect(url_for('dashboard'))
@@ -302,8 +783,10 @@ def edit_expense():
     amount = request.form.get('amount')
     date = request.form.get('date')
     location = request.form.get('location')
+    currency = request.form.get('currency')
 
     amount_changed = False
+    conversion_changed = False
     if description is not None:
         expense.description = description
     if amount:
@@ -314,12 +797,22 @@ def edit_expense():
         if abs(new_amount - expense.amount) > 1e-9:
             amount_changed = True
             expense.amount = new_amount
+    if currency:
+        currency = currency.strip().upper()
+        if not valid_currency(currency):
+            return 'Invalid currency code', 400
+        if currency != expense.currency:
+            expense.currency = currency
+            conversion_changed = True
     if date:
         try:
-            expense.date = datetime.fromisoformat(date)
+            new_date = datetime.fromisoformat(date)
         except Exception:
             # ignore invalid date formatting and leave unchanged
-            pass
+            new_date = expense.date
+        if new_date != expense.date:
+            expense.date = new_date
+            conversion_changed = True
     # handle optional receipt replacement
     file = request.files.get('receipt')
     if file and file.filename and allowed_file(file.filename):
@@ -331,22 +824,34 @@ def edit_expense():
         # set or clear location
         expense.location = location or None
 
+    group = Group.query.get(expense.group_id)
+    splits = sess.execute(db.select(ExpenseSplit).filter_by(expense_id=expense.id)).scalars().all()
     # If amount changed, recompute splits for this expense equally across group members
     if amount_changed:
-        group = Group.query.get(expense.group_id)
         members = group.members if group else []
         if members:
             per_person_share = float(expense.amount) / len(members)
-            splits = ExpenseSplit.query.filter_by(expense_id=expense.id).all()
             for s in splits:
                 s.amount = per_person_share
 
-    db.session.commit()
+    # Refresh the stored base-currency amounts whenever their inputs changed
+    if group and (amount_changed or conversion_changed):
+        try:
+            expense.base_amount = rates.convert(expense.amount, expense.currency, group.base_currency, expense.date)
+        except MissingRateError as e:
+            return str(e), 400
+        ratio = expense.base_amount / expense.amount if expense.amount else 0.0
+        for s in splits:
+            s.base_amount = s.amount * ratio
+
+    if not shard_router.commit(sess, expense.group_id):
+        return GROUP_MOVING_RESPONSE
     return redirect(url_for('dashboard'))
 
 
 @app.route('/join_group', methods=['POST'])
 @login_required
+@idempotent
 def join_group():
     tag = request.form.get('group_tag')
     if not tag:
@@ -359,6 +864,7 @@ def join_group():
         flash('You are already a member of this group.')
         return redirect(url_for('dashboard'))
     group.members.append(user)
+    group.members_changed_at = datetime.utcnow()
     db.session.commit()
     flash(f'Joined group {group.name}')
     return redirect(url_for('dashboard'))
@@ -366,6 +872,7 @@ def join_group():
 
 @app.route('/leave_group', methods=['POST'])
 @login_required
+@idempotent
 def leave_group():
     group_id = request.form.get('group_id')
     if not group_id:
@@ -378,6 +885,7 @@ def leave_group():
         flash('You are not a member of this group.')
         return redirect(url_for('dashboard'))
     group.members.remove(user)
+    group.members_changed_at = datetime.utcnow()
     db.session.commit()
     flash(f'Left group {group.name}')
     return redirect(url_for('dashboard'))
@@ -385,11 +893,15 @@ def leave_group():
 
 @app.route('/delete_expense', methods=['POST'])
 @login_required
+@idempotent
 def delete_expense():
     expense_id = request.form.get('expense_id')
     if not expense_id:
         return 'expense_id required', 400
-    expense = Expense.query.get(expense_id)
+    sess = shard_session_from_form()
+    if sess is None:
+        return 'group_id required', 400
+    expense = sess.get(Expense, expense_id)
     if not expense:
         return 'Expense not found', 404
     # Only payer can delete
@@ -397,19 +909,24 @@ def delete_expense():
         return 'Not authorized to delete this expense', 403
 
     # delete splits first
-    ExpenseSplit.query.filter_by(expense_id=expense.id).delete()
-    db.session.delete(expense)
-    db.session.commit()
+    sess.execute(db.delete(ExpenseSplit).where(ExpenseSplit.expense_id == expense.id))
+    sess.delete(expense)
+    if not shard_router.commit(sess, expense.group_id):
+        return GROUP_MOVING_RESPONSE
     return redirect(url_for('dashboard'))
 
 
 @app.route('/settle_split', methods=['POST'])
 @login_required
+@idempotent
 def settle_split():
     split_id = request.form.get('split_id')
     if not split_id:
         return 'split_id required', 400
-    split = ExpenseSplit.query.get(split_id)
+    sess = shard_session_from_form()
+    if sess is None:
+        return 'group_id required', 400
+    split = sess.get(ExpenseSplit, split_id)
     if not split:
         return 'Split not found', 404
     if split.user_id != session.get('user_id'):
@@ -422,18 +939,31 @@ def settle_split():
         file.save(path)
         split.receipt_image = filename
     split.is_settled = True
-    db.session.commit()
+    expense = sess.get(Expense, split.expense_id)
+    if expense and not shard_router.commit(sess, expense.group_id):
+        return GROUP_MOVING_RESPONSE
+    if not expense:
+        sess.commit()
+
+    # Let the payer know in their next digest
+    if expense and expense.payer_id != split.user_id:
+        outbox.notify(expense.payer_id, f"{session.get('username')} settled {split.amount:.2f} {expense.currency} for '{expense.description}'")
+        db.session.commit()
     return redirect(url_for('dashboard'))
 
 # This route will help us to create a group we need groups to split expenses
 @app.route('/create_group', methods=['POST'])
+@idempotent
 def create_group():
     if request.method == "POST":
         group_name = request.form.get('group_name')
         members_emails_str = request.form.get('members')
+        base_currency = (request.form.get('base_currency') or DEFAULT_CURRENCY).strip().upper()
 
     if not group_name:
         return 'Group name is required!', 400
+    if not valid_currency(base_currency):
+        return 'Invalid currency code', 400
 
     existing_group = Group.query.filter_by(name=group_name).first()
     if existing_group:
@@ -449,7 +979,7 @@ def create_group():
     while Group.query.filter_by(tag=tag).first():
         tag = f"{base}-{random.randint(1000,9999)}"
 
-    new_group = Group(name=group_name, tag=tag)
+    new_group = Group(name=group_name, tag=tag, base_currency=base_currency)
     
     if members_emails_str:
         members_emails = members_emails_str.split(',')
@@ -465,6 +995,7 @@ def create_group():
 
 
 @app.route('/add_expense', methods=['POST'])
+@idempotent
 def add_expense():
     if request.method == "POST":
         group_name = request.form.get('group_name_expense')
@@ -473,6 +1004,7 @@ def add_expense():
         paid_by = request.form.get('paid_by')
         date = request.form.get('date') #Optional
         location = request.form.get('location')
+        currency = request.form.get('currency') #Optional, defaults to the group's base currency
         # Find the group by name
         group = Group.query.filter_by(name=group_name).first()
         if not group:
@@ -503,18 +1035,32 @@ def add_expense():
         else:
             expense_date = datetime.utcnow()
 
+        # Convert once here so balances can be summed without converting on read
+        currency = (currency or group.base_currency).strip().upper()
+        if not valid_currency(currency):
+            return 'Invalid currency code', 400
+        try:
+            base_amount = rates.convert(amount, currency, group.base_currency, expense_date)
+        except MissingRateError as e:
+            return str(e), 400
+        per_person_base = base_amount / len(members)
+
+        # Expense and splits are written to the shard that owns this group
+        sess = shard_router.session_for(group.id)
         expense = Expense(
             group_id=group.id,
             description=description,
             amount=amount,
+            currency=currency,
+            base_amount=base_amount,
             location=location,
             payer_id=payer.id,
             date=expense_date
         )
 
-        db.session.add(expense)
+        sess.add(expense)
         # flush so expense.id is available for splits before commit
-        db.session.flush()
+        sess.flush()
 
         # Handle optional receipt upload for the expense
         file = request.files.get('receipt')
@@ -534,16 +1080,26 @@ def add_expense():
                 expense_id=expense.id,
                 user_id=member.id,
                 amount=per_person_share,
+                base_amount=per_person_base,
             )
-            db.session.add(split)
-
-        db.session.commit()
+            sess.add(split)
+            outbox.notify(member.id, f"{payer.username} added '{description}' in {group.name}: you owe {per_person_share:.2f} {currency}")
+
+        if not shard_router.commit(sess, group.id):
+            db.session.rollback()
+            return GROUP_MOVING_RESPONSE
+        # With sharding the notifications live in app.db, not the expense shard
+        if sess is not db.session:
+            db.session.commit()
         return redirect(url_for('dashboard'))
 
 
 if __name__ == '__main__':
-    # Ensure database tables are created inside the application context
+    # Ensure tables and columns exist inside the application context
     with app.app_context():
-        db.create_all()
+        upgrade_database()
+    # Only the reloader child serves requests, so only it runs the sender
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        outbox.start(app)
     app.run(debug=True)
 
@@ -0,0 +1,90 @@
+"""Multi-writer benchmark for the group-sharded database layout.
+
+Runs the same write-heavy workload (one expense plus its splits per
+transaction, spread over many groups) against 1, 2, 4 and 8 shards and
+reports committed expenses per second:
+
+    python bench_shards.py --writers 8 --expenses 200
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from sqlalchemy.orm import Session
+
+# Keep the benchmark's groups and placements out of the real app.db
+MAIN_DB_DIR = tempfile.mkdtemp(prefix='sharepay-bench-')
+os.environ['SHAREPAY_DATABASE_URI'] = 'sqlite:///' + os.path.join(MAIN_DB_DIR, 'app.db')
+
+from app import app, db, shard_router, Expense, ExpenseSplit  # noqa: E402
+
+
+def write_expenses(group_ids, count, splits_per_expense, barrier):
+    with app.app_context():
+        # Resolve placements up front so the timed loop only touches shards
+        engines = {gid: shard_router.engines[shard_router.shard_for(gid)] for gid in group_ids}
+    barrier.wait()
+    for i in range(count):
+        group_id = group_ids[i % len(group_ids)]
+        with Session(engines[group_id]) as sess:
+            expense = Expense(description=f'bench {i}', amount=90.0, payer_id=1, group_id=group_id)
+            sess.add(expense)
+            sess.flush()
+            for user_id in range(2, 2 + splits_per_expense):
+                sess.add(ExpenseSplit(expense_id=expense.id, user_id=user_id, amount=90.0 / (splits_per_expense + 1)))
+            sess.commit()
+
+
+def run(shard_count, writers, expenses, groups, splits_per_expense):
+    with tempfile.TemporaryDirectory() as tmp:
+        app.config['SHARD_COUNT'] = shard_count
+        app.config['SHARD_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp, 'shard_{shard}.db')
+        shard_router.init_app(app)
+        with app.app_context():
+            db.create_all()
+            shard_router.create_all()
+
+        barrier = threading.Barrier(writers + 1)
+        threads = []
+        for w in range(writers):
+            # Each writer works on its own slice of groups
+            group_ids = list(range(w + 1, groups + 1, writers)) or [w + 1]
+            t = threading.Thread(target=write_expenses, args=(group_ids, expenses, splits_per_expense, barrier))
+            t.start()
+            threads.append(t)
+        barrier.wait()
+        start = time.perf_counter()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        shard_router.dispose()
+    return writers * expenses / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--expenses', type=int, default=200, help='expenses written per writer')
+    parser.add_argument('--groups', type=int, default=64)
+    parser.add_argument('--splits', type=int, default=3, help='splits per expense')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    baseline = None
+    print(f'{"shards":>6} {"expenses/s":>12} {"speedup":>8}')
+    try:
+        for count in args.shards:
+            rate = run(count, args.writers, args.expenses, args.groups, args.splits)
+            baseline = baseline or rate
+            print(f'{count:>6} {rate:>12.1f} {rate / baseline:>7.2f}x')
+    finally:
+        with app.app_context():
+            db.engine.dispose()
+        shutil.rmtree(MAIN_DB_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
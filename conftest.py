@@ -0,0 +1,120 @@
+"""Test harness: one private database per test process, reset per test.
+
+Each pytest process, including every pytest-xdist worker (`pytest -n auto`),
+gets its own SQLite file, so tests can run in parallel without touching
+app.db or each other. The schema is built once per process and kept as an
+in-memory template. Before every test the template is copied over the
+process's database with the SQLite backup API, which takes about a
+millisecond and gives each test a clean database.
+
+The app, mail, shard_router and the login limiters are still the shared
+module-level objects from app.py; fixtures that change their config restore
+it afterwards.
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+from contextlib import closing
+from types import SimpleNamespace
+
+import pytest
+
+# The engine is created when app.py is imported, so the database location
+# (and a cheap bcrypt work factor) must be in the environment before that.
+# Only the path is chosen here: the directory is made by schema_template, so
+# a process that never runs a test (the xdist controller, a collection
+# error) leaves nothing behind.
+WORKER = os.environ.get('PYTEST_XDIST_WORKER', 'main')
+WORK_DIR = os.path.join(tempfile.gettempdir(), f'sharepay-test-{WORKER}-{os.getpid()}')
+DB_PATH = os.path.join(WORK_DIR, 'app.db')
+os.environ['SHAREPAY_DATABASE_URI'] = 'sqlite:///' + DB_PATH
+os.environ.setdefault('SHAREPAY_BCRYPT_ROUNDS', '4')
+
+from app import app, db, User, Group  # noqa: E402
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'perf: performance smoke test (deselect with -m "not perf")')
+
+
+@pytest.fixture(scope='session')
+def schema_template():
+    os.makedirs(WORK_DIR, exist_ok=True)
+    try:
+        with app.app_context():
+            db.create_all()
+        template = sqlite3.connect(':memory:', check_same_thread=False)
+        with closing(sqlite3.connect(DB_PATH)) as built:
+            built.backup(template)
+        yield template
+        template.close()
+    finally:
+        with app.app_context():
+            db.engine.dispose()
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+@pytest.fixture(autouse=True)
+def fresh_database(schema_template):
+    # Overwrite whatever the previous test left with the pristine schema
+    with closing(sqlite3.connect(DB_PATH)) as target:
+        schema_template.backup(target)
+    yield DB_PATH
+
+
+@pytest.fixture
+def app_context(fresh_database):
+    with app.app_context() as ctx:
+        yield ctx
+        db.session.remove()
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+@pytest.fixture
+def users(app_context):
+    """alice, bob and carol, in no group yet."""
+    people = {name: User(username=name, email=f'{name}@example.com', password='pw')
+              for name in ('alice', 'bob', 'carol')}
+    db.session.add_all(people.values())
+    db.session.commit()
+    return SimpleNamespace(**people)
+
+
+@pytest.fixture
+def make_group(app_context):
+    def make(name, members, **columns):
+        group = Group(name=name, tag=f'{name.lower()}-1', **columns)
+        group.members.extend(members)
+        db.session.add(group)
+        db.session.commit()
+        return group
+    return make
+
+
+@pytest.fixture
+def login_as(client):
+    def login(user):
+        with client.session_transaction() as sess:
+            sess['user_id'] = user.id
+            sess['username'] = user.username
+    return login
+
+
+@pytest.fixture
+def add_expense(client):
+    """POST /add_expense as paid by alice; extra fields go into the form."""
+    def post(group_name, description, amount, key=None, **fields):
+        headers = {'Idempotency-Key': key} if key else {}
+        return client.post('/add_expense', data=dict(
+            group_name_expense=group_name,
+            description=description,
+            amount=amount,
+            paid_by='alice@example.com',
+            **fields
+        ), headers=headers)
+    return post
@@ -0,0 +1,226 @@
+import logging
+import os
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, Integer, MetaData, Table, and_, bindparam, exists, func, select, union
+from sqlalchemy.orm import Session
+
+log = logging.getLogger(__name__)
+
+Violation = namedtuple('Violation', 'kind expense_id split_id detail')
+
+# Per-connection scratch table holding the memberships of the groups in the
+# batch being checked; group membership lives in app.db, which is a different
+# database from the expense shards.
+_scratch = MetaData()
+batch_members = Table(
+    'consistency_batch_members', _scratch,
+    Column('group_id', Integer, primary_key=True),
+    Column('user_id', Integer, primary_key=True),
+    prefixes=['TEMPORARY']
+)
+
+
+class ConsistencyChecker:
+    """Incremental checker for expense, split and membership invariants.
+
+    Only expenses touched since the last checkpoint are examined: expenses or
+    splits whose updated_at moved, plus every expense of a group whose
+    membership changed. Candidates are processed in id-ordered batches, each
+    in its own short transaction, and every invariant is evaluated with one
+    grouped SQL query per batch.
+
+    Invariants:
+      * split_total: the splits of an expense add up to its amount, either
+        with or without one extra share for the payer.
+      * ex_member_split: unsettled splits belong to current group members.
+      * orphan_split: every split points at an existing expense.
+
+    With repair=True, expenses without settled splits are fixed in place:
+    ex-member splits are dropped and the remaining splits are reset to equal
+    shares. Expenses with settled splits are reported only.
+    """
+
+    def __init__(self, db, router, expense_model, split_model, group_model, members_table, checkpoint_model):
+        self.db = db
+        self.router = router
+        self.Expense = expense_model
+        self.Split = split_model
+        self.Group = group_model
+        self.members = members_table
+        self.Checkpoint = checkpoint_model
+
+    def engines(self):
+        if self.router.enabled:
+            return [(f'shard{i}', engine) for i, engine in enumerate(self.router.engines)]
+        return [('main', self.db.engine)]
+
+    def run(self, app, repair=False, full=False):
+        """Check every database once and return the list of violations."""
+        cfg = app.config
+        violations = []
+        for name, engine in self.engines():
+            started = datetime.utcnow()
+            checkpoint = None if full else self._checkpoint(name)
+            found = self._check_database(engine, checkpoint, repair,
+                                         cfg['CONSISTENCY_BATCH_SIZE'], cfg['CONSISTENCY_PAUSE'])
+            violations.extend(found)
+            # Overlap the next scan slightly so rows from transactions that
+            # were in flight when this scan started are not skipped.
+            self._save_checkpoint(name, started - timedelta(seconds=cfg['CONSISTENCY_OVERLAP']))
+        for v in violations:
+            log.warning('Consistency violation %s: expense=%s split=%s %s', v.kind, v.expense_id, v.split_id, v.detail)
+        return violations
+
+    def run_forever(self, app, repair=False, full=False):
+        # Best effort: let request-serving processes win the CPU
+        try:
+            os.nice(10)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            try:
+                with app.app_context():
+                    self.run(app, repair=repair, full=full)
+            except Exception:
+                # A locked or briefly unavailable database must not end the loop
+                log.exception('Consistency check failed')
+            time.sleep(app.config['CONSISTENCY_CHECK_INTERVAL'])
+
+    def _checkpoint(self, name):
+        row = self.db.session.get(self.Checkpoint, name)
+        return row.checked_until if row else None
+
+    def _save_checkpoint(self, name, when):
+        self.db.session.merge(self.Checkpoint(name=name, checked_until=when))
+        self.db.session.commit()
+
+    def _candidates(self, checkpoint):
+        E, S = self.Expense, self.Split
+        if checkpoint is None:
+            return select(E.id.label('id')).subquery()
+        changed_groups = self.db.session.execute(
+            select(self.Group.id).where(self.Group.members_changed_at > checkpoint)
+        ).scalars().all()
+        return union(
+            select(E.id.label('id')).where(E.updated_at > checkpoint),
+            select(S.expense_id.label('id')).where(S.updated_at > checkpoint),
+            select(E.id.label('id')).where(E.group_id.in_(changed_groups))
+        ).subquery()
+
+    def _check_database(self, engine, checkpoint, repair, batch_size, pause):
+        violations = self._orphan_splits(engine, checkpoint, repair)
+        candidates = self._candidates(checkpoint)
+        last_id = 0
+        while True:
+            with Session(engine) as session:
+                batch = session.execute(
+                    select(candidates.c.id).where(candidates.c.id > last_id).order_by(candidates.c.id).limit(batch_size)
+                ).scalars().all()
+            if not batch:
+                return violations
+            violations.extend(self._check_batch(engine, batch, repair))
+            last_id = batch[-1]
+            # Give writers room between batches
+            time.sleep(pause)
+
+    def _load_members(self, session, group_ids):
+        batch_members.create(session.connection(), checkfirst=True)
+        session.execute(batch_members.delete())
+        rows = self.db.session.execute(
+            select(self.members.c.group_id, self.members.c.user_id).where(self.members.c.group_id.in_(group_ids))
+        ).all()
+        if rows:
+            session.execute(batch_members.insert(), [{'group_id': g, 'user_id': u} for g, u in rows])
+        return {(g, u) for g, u in rows}
+
+    def _check_batch(self, engine, expense_ids, repair):
+        E, S = self.Expense, self.Split
+        eps = 1e-6
+        # Short transaction; only the scratch table is written unless repairing
+        with Session(engine) as session, session.begin():
+            group_ids = session.execute(
+                select(E.group_id).where(E.id.in_(expense_ids)).distinct()
+            ).scalars().all()
+            self._load_members(session, group_ids)
+            is_member = exists().where(batch_members.c.group_id == E.group_id, batch_members.c.user_id == S.user_id)
+            ex_members = session.execute(
+                select(S.id, S.expense_id, S.user_id, E.group_id)
+                .join(E, E.id == S.expense_id)
+                .where(E.id.in_(expense_ids), S.is_settled == False, ~is_member)
+            ).all()
+
+            total = func.sum(S.amount)
+            share = func.max(S.amount)
+            bad_totals = session.execute(
+                select(E.id, E.amount, total, func.count(S.id))
+                .join(S, S.expense_id == E.id)
+                .where(E.id.in_(expense_ids))
+                .group_by(E.id)
+                .having(and_(func.abs(total - E.amount) > eps, func.abs(total + share - E.amount) > eps))
+            ).all()
+
+            violations = [
+                Violation('ex_member_split', expense_id, split_id, f'user {user_id} is not in group {group_id}')
+                for split_id, expense_id, user_id, group_id in ex_members
+            ] + [
+                Violation('split_total', expense_id, None, f'{count} splits total {split_total:.2f} for amount {amount:.2f}')
+                for expense_id, amount, split_total, count in bad_totals
+            ]
+            if repair and violations:
+                self._repair(session, ex_members, bad_totals)
+        return violations
+
+    def _repair(self, session, ex_members, bad_totals):
+        E, S = self.Expense, self.Split
+        eps = 1e-6
+        touched = {row.expense_id for row in ex_members} | {row[0] for row in bad_totals}
+        fixable = session.execute(
+            select(E.id).where(E.id.in_(touched), ~exists().where(S.expense_id == E.id, S.is_settled == True))
+        ).scalars().all()
+        if not fixable:
+            return
+        # The payer keeps a share when the splits did not cover the whole
+        # amount. Read this from the rows, not from current membership: a
+        # payer who has since left still paid their own share.
+        totals = dict(session.execute(
+            select(S.expense_id, func.sum(S.amount)).where(S.expense_id.in_(fixable)).group_by(S.expense_id)
+        ).all())
+        session.execute(S.__table__.delete().where(
+            S.id.in_([row.id for row in ex_members if row.expense_id in fixable])
+        ))
+        # Reset the remaining splits of each fixable expense to equal shares
+        rows = session.execute(
+            select(E.id, E.amount, E.base_amount, func.count(S.id))
+            .join(S, S.expense_id == E.id)
+            .where(E.id.in_(fixable))
+            .group_by(E.id)
+        ).all()
+        updates = []
+        for expense_id, amount, base_amount, count in rows:
+            payer_share = totals.get(expense_id, 0) < amount - eps
+            share = amount / (count + payer_share)
+            ratio = base_amount / amount if base_amount is not None and amount else 1.0
+            updates.append({'eid': expense_id, 'share': share, 'base_share': share * ratio})
+        if updates:
+            split_table = S.__table__
+            session.execute(
+                split_table.update()
+                .where(split_table.c.expense_id == bindparam('eid'))
+                .values(amount=bindparam('share'), base_amount=bindparam('base_share')),
+                updates
+            )
+        log.info('Repaired %d expenses', len(fixable))
+
+    def _orphan_splits(self, engine, checkpoint, repair):
+        E, S = self.Expense, self.Split
+        query = select(S.id, S.expense_id).where(~exists().where(E.id == S.expense_id))
+        if checkpoint is not None:
+            query = query.where(S.updated_at > checkpoint)
+        with Session(engine) as session, session.begin():
+            rows = session.execute(query).all()
+            if repair and rows:
+                session.execute(S.__table__.delete().where(S.id.in_([r.id for r in rows])))
+        return [Violation('orphan_split', expense_id, split_id, 'expense does not exist') for split_id, expense_id in rows]
@@ -0,0 +1,108 @@
+import csv
+from datetime import date, datetime
+from functools import lru_cache
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+
+class MissingRateError(LookupError):
+    pass
+
+
+class ExchangeRates:
+    """Exchange-rate lookups backed by a local rate table.
+
+    Every rate is stored as units of `currency` per one unit of the pivot
+    currency, so any pair converts through the pivot. The latest rate on or
+    before the day is used, which covers weekends and holidays. Lookups for
+    past days that found a rate go through an in-memory LRU; misses and
+    today's date are always read from the table. Every write stamps the
+    rate's updated_at, and the LRU is dropped whenever the newest stamp
+    changes, so rates imported by another process are seen on the next
+    lookup.
+    """
+
+    def __init__(self, db, rate_model, pivot='USD', cache_size=4096):
+        self.db = db
+        self.rate_model = rate_model
+        self.pivot = pivot
+        self._cached_rate = lru_cache(maxsize=cache_size)(self._lookup_known_rate)
+        self.cache_info = self._cached_rate.cache_info
+        self.cache_clear = self._cached_rate.cache_clear
+        self._cached_version = None
+
+    def rate(self, currency, day):
+        """Units of currency per pivot unit on day, or None if there is none."""
+        if day >= date.today():
+            return self._lookup_rate(currency, day)
+        # One index lookup; cheaper than the rate query it may save
+        version = self.db.session.execute(select(func.max(self.rate_model.updated_at))).scalar()
+        if version != self._cached_version:
+            self.cache_clear()
+            self._cached_version = version
+        try:
+            return self._cached_rate(currency, day)
+        except MissingRateError:
+            return None
+
+    def _lookup_known_rate(self, currency, day):
+        rate = self._lookup_rate(currency, day)
+        if rate is None:
+            # lru_cache does not store exceptions, so misses are retried
+            raise MissingRateError(currency, day)
+        return rate
+
+    def _lookup_rate(self, currency, day):
+        if currency == self.pivot:
+            return 1.0
+        Rate = self.rate_model
+        return self.db.session.execute(
+            self.db.select(Rate.rate)
+            .where(Rate.currency == currency, Rate.date <= day)
+            .order_by(Rate.date.desc())
+            .limit(1)
+        ).scalar()
+
+    def convert(self, amount, from_currency, to_currency, when=None):
+        if from_currency == to_currency:
+            return float(amount)
+        day = when.date() if isinstance(when, datetime) else (when or date.today())
+        from_rate = self.rate(from_currency, day)
+        to_rate = self.rate(to_currency, day)
+        for currency, rate in ((from_currency, from_rate), (to_currency, to_rate)):
+            if not rate:
+                raise MissingRateError(f'No exchange rate for {currency} on {day.isoformat()}')
+        return float(amount) / from_rate * to_rate
+
+    def import_csv(self, path, chunk_size=5000):
+        """Bulk load a date,currency,rate CSV, replacing rates already stored.
+
+        Returns the number of rows read.
+        """
+        Rate = self.rate_model
+        stmt = sqlite_insert(Rate)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Rate.currency, Rate.date],
+            set_={'rate': stmt.excluded.rate, 'updated_at': datetime.utcnow()}
+        )
+        count = 0
+        chunk = []
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                chunk.append({
+                    'currency': row['currency'].strip().upper(),
+                    'date': date.fromisoformat(row['date'].strip()),
+                    'rate': float(row['rate'])
+                })
+                if len(chunk) >= chunk_size:
+                    self.db.session.execute(stmt, chunk)
+                    count += len(chunk)
+                    chunk = []
+        if chunk:
+            self.db.session.execute(stmt, chunk)
+            count += len(chunk)
+        self.db.session.commit()
+        # Cached lookups may now be stale
+        self.cache_clear()
+        return count
@@ -0,0 +1,110 @@
+"""Minimal SMTP sink for local development and tests.
+
+Accepts every message, keeps it in memory and (when run directly) prints it,
+so the mail sender can be exercised without a real mail server:
+
+    python debug_smtp.py --port 1025
+    MAIL_SUPPRESS_SEND=0 MAIL_SERVER=127.0.0.1 MAIL_PORT=1025 python app.py
+"""
+import argparse
+import email
+import socketserver
+import threading
+
+
+def _address(command):
+    # "MAIL FROM:<a@example.com> SIZE=123" -> "a@example.com"
+    arg = command.split(':', 1)[1].strip()
+    return arg[1:arg.index('>')] if arg.startswith('<') else arg.split()[0]
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        self.reply('220 localhost SharePay debugging SMTP')
+        mail_from, rcpt_to = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command[:4].upper()
+            if verb == 'EHLO' or verb == 'HELO':
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                mail_from, rcpt_to = _address(command), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                rcpt_to.append(_address(command))
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for raw in iter(self.rfile.readline, b''):
+                    if raw in (b'.\r\n', b'.\n'):
+                        break
+                    # Undo SMTP dot-stuffing
+                    data.append(raw[1:] if raw.startswith(b'..') else raw)
+                self.server.deliver(mail_from, rcpt_to, b''.join(data))
+                self.reply('250 OK: queued')
+            elif verb == 'RSET':
+                mail_from, rcpt_to = None, []
+                self.reply('250 OK')
+            elif verb == 'NOOP':
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class DebuggingSMTPServer(socketserver.ThreadingTCPServer):
+    """Threaded SMTP sink that records (mail_from, rcpt_to, message) tuples."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, echo=False):
+        super().__init__((host, port), _SMTPHandler)
+        self.lock = threading.Lock()
+        self.messages = []
+        self.connections = 0
+        self.echo = echo
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def deliver(self, mail_from, rcpt_to, data):
+        message = email.message_from_bytes(data)
+        with self.lock:
+            self.messages.append((mail_from, rcpt_to, message))
+        if self.echo:
+            print(f'---------- from {mail_from} to {", ".join(rcpt_to)}')
+            print(data.decode('utf-8', 'replace'))
+
+    def start(self):
+        # Short poll interval keeps stop() quick, which matters in tests
+        self._thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print every message sent to this SMTP server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1025)
+    args = parser.parse_args()
+    server = DebuggingSMTPServer(args.host, args.port, echo=True)
+    print(f'Debugging SMTP server listening on {args.host}:{server.port}')
+    server.serve_forever()
@@ -0,0 +1,155 @@
+import hashlib
+from datetime import datetime, timedelta
+
+from flask import Response
+from flask_sqlalchemy.session import Session
+from sqlalchemy.exc import IntegrityError
+
+
+def digest(*parts):
+    # 16 bytes of sha256 keeps the key table compact while staying collision-safe
+    return hashlib.sha256('\x1f'.join(str(p) for p in parts).encode('utf-8')).digest()[:16]
+
+
+class DeferredCommitSession(Session):
+    """db.session class that can hold a request's commits until it finishes.
+
+    While deferred, commit() only flushes and starts a savepoint, so the
+    handler's writes and its stored idempotent response are committed
+    together by IdempotencyStore.complete(). Work done after the handler's
+    last commit() is rolled back there, as an uncommitted transaction would be.
+    """
+
+    def commit(self):
+        if not self.info.get('defer_commits'):
+            return super().commit()
+        self.flush()
+        savepoint = self.info.get('savepoint')
+        if savepoint is not None and savepoint.is_active:
+            savepoint.commit()
+        elif not getattr(self.connection().connection.dbapi_connection, 'in_transaction', True):
+            # Nothing written yet. A SAVEPOINT would start pysqlite's transaction
+            # behind its back and its RELEASE would then really commit.
+            return
+        self.info['savepoint'] = self.begin_nested()
+
+
+class IdempotencyStore:
+    """Remembers the response to each (user, Idempotency-Key) for a TTL.
+
+    A key is claimed by inserting a row with no status before the handler
+    runs; concurrent retries see that row and are told to try again, later
+    retries get the stored response back without re-running the handler.
+    A claim that is never completed (the process died mid-request) can be
+    taken over once its lease runs out.
+    """
+
+    def __init__(self, db, model):
+        self.db = db
+        self.model = model
+        self._last_purge = None
+
+    def claim(self, scope, key, fingerprint, ttl, lease):
+        """Return (row_key, existing_row); existing_row is None if we now own the key."""
+        session = self.db.session
+        now = datetime.utcnow()
+        row_key = digest(scope, key)
+        row = session.get(self.model, row_key, populate_existing=True)
+        if row is None:
+            session.add(self.model(key=row_key, fingerprint=fingerprint, claimed_at=now, expires_at=now + ttl))
+            try:
+                session.commit()
+                return row_key, None
+            except IntegrityError:
+                # Another request claimed the key first
+                session.rollback()
+                row = session.get(self.model, row_key)
+        if row is None or not self._reclaimable(row, now, lease):
+            return row_key, row
+        Key = self.model
+        # Expired keys and abandoned claims are taken over, but only by one
+        # request: the UPDATE re-checks the condition under the write lock
+        taken = session.execute(
+            self.db.update(Key)
+            .where(Key.key == row_key, self.db.or_(
+                Key.expires_at <= now,
+                self.db.and_(Key.status_code == None,
+                             self.db.or_(Key.claimed_at == None, Key.claimed_at <= now - lease))))
+            .values(fingerprint=fingerprint, status_code=None, location=None, content_type=None, body=None,
+                    claimed_at=now, expires_at=now + ttl)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        session.commit()
+        if taken:
+            return row_key, None
+        return row_key, session.get(self.model, row_key, populate_existing=True)
+
+    @staticmethod
+    def _reclaimable(row, now, lease):
+        if row.expires_at <= now:
+            return True
+        # Still running, unless its lease ran out (rows from before leases have none)
+        return row.status_code is None and (row.claimed_at is None or row.claimed_at <= now - lease)
+
+    def defer_commits(self):
+        """Make the handler's db.session commits part of complete()'s transaction."""
+        self.db.session.info['defer_commits'] = True
+
+    def _end_deferral(self):
+        session = self.db.session
+        session.info.pop('defer_commits', None)
+        return session.info.pop('savepoint', None)
+
+    def complete(self, row_key, response):
+        session = self.db.session
+        deferred = session.info.get('defer_commits')
+        savepoint = self._end_deferral()
+        try:
+            if deferred and savepoint is not None:
+                # Keep what the handler committed, drop what it left pending
+                if savepoint.is_active:
+                    savepoint.rollback()
+            else:
+                # Whatever the handler left uncommitted would have been discarded
+                session.rollback()
+            self._store_response(row_key, response)
+            session.commit()
+        except Exception:
+            # Nothing of this request is kept; the claim is retried after its lease
+            session.rollback()
+            raise
+
+    def _store_response(self, row_key, response):
+        self.db.session.execute(
+            self.db.update(self.model).where(self.model.key == row_key).values(
+                status_code=response.status_code,
+                location=response.headers.get('Location'),
+                content_type=response.headers.get('Content-Type'),
+                body=response.get_data()
+            )
+        )
+
+    def release(self, row_key):
+        session = self.db.session
+        # With deferred commits this also drops everything the handler wrote
+        self._end_deferral()
+        session.rollback()
+        session.execute(self.db.delete(self.model).where(self.model.key == row_key))
+        session.commit()
+
+    def replay(self, row):
+        response = Response(row.body, status=row.status_code, content_type=row.content_type)
+        if row.location:
+            response.headers['Location'] = row.location
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    def purge_expired(self, interval=None):
+        """Delete expired keys; with interval, at most once per that many seconds."""
+        now = datetime.utcnow()
+        if interval is not None and self._last_purge and now - self._last_purge < timedelta(seconds=interval):
+            return 0
+        self._last_purge = now
+        result = self.db.session.execute(self.db.delete(self.model).where(self.model.expires_at <= now))
+        self.db.session.commit()
+        return result.rowcount
@@ -0,0 +1,59 @@
+from collections import namedtuple
+
+from sqlalchemy import inspect, text
+
+# One column added to a table after it first shipped. ddl is the column
+# definition for ALTER TABLE ... ADD COLUMN, so NOT NULL columns need a
+# constant DEFAULT. backfill is an SQL expression assigned to the column for
+# rows that existed before the upgrade.
+ColumnUpgrade = namedtuple('ColumnUpgrade', 'table column ddl backfill index', defaults=(None, False))
+# An index added to a column that existed before, named the way
+# db.create_all() names an index=True column.
+IndexUpgrade = namedtuple('IndexUpgrade', 'table column')
+
+
+def upgrade_schema(engine, upgrades):
+    """Add the missing columns and indexes listed in upgrades to engine.
+
+    db.create_all() only creates missing tables and never alters existing
+    ones, so databases created by an older version need this. Tables that do
+    not exist yet are skipped, since create_all builds them complete. Columns
+    already present are left alone, so running it again is a no-op. All
+    changes are made in one transaction. Returns the "table.column" names
+    and index names that were added.
+    """
+    added = []
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        tables = set(inspector.get_table_names())
+        quote = conn.dialect.identifier_preparer.quote
+        columns = {}
+        indexes = {}
+        for upgrade in upgrades:
+            if upgrade.table not in tables:
+                continue
+            if isinstance(upgrade, IndexUpgrade):
+                if upgrade.table not in indexes:
+                    indexes[upgrade.table] = {i['name'] for i in inspector.get_indexes(upgrade.table)}
+                index = f'ix_{upgrade.table}_{upgrade.column}'
+                if index not in indexes[upgrade.table]:
+                    conn.execute(text(f'CREATE INDEX {quote(index)} ON {quote(upgrade.table)} '
+                                      f'({quote(upgrade.column)})'))
+                    indexes[upgrade.table].add(index)
+                    added.append(index)
+                continue
+            if upgrade.table not in columns:
+                columns[upgrade.table] = {c['name'] for c in inspector.get_columns(upgrade.table)}
+            if upgrade.column in columns[upgrade.table]:
+                continue
+            table, column = quote(upgrade.table), quote(upgrade.column)
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {upgrade.ddl}'))
+            if upgrade.backfill is not None:
+                conn.execute(text(f'UPDATE {table} SET {column} = {upgrade.backfill}'))
+            if upgrade.index:
+                # Same name db.create_all() gives an index=True column
+                index = quote(f'ix_{upgrade.table}_{upgrade.column}')
+                conn.execute(text(f'CREATE INDEX {index} ON {table} ({column})'))
+            columns[upgrade.table].add(upgrade.column)
+            added.append(f'{upgrade.table}.{upgrade.column}')
+    return added
@@ -0,0 +1,183 @@
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from flask_mail import Message
+
+log = logging.getLogger(__name__)
+
+
+class MailOutbox:
+    """Queues mail in the database and delivers it from a background thread.
+
+    Routes only ever call enqueue() or notify(), which add rows to the current
+    db.session; nothing talks to the SMTP server inside a request. The sender
+    turns pending notification events into one digest per user, then delivers
+    due messages in batches over a single SMTP connection, retrying failures
+    with exponential backoff.
+    """
+
+    def __init__(self, db, mail, message_model, event_model, user_model):
+        self.db = db
+        self.mail = mail
+        self.message_model = message_model
+        self.event_model = event_model
+        self.user_model = user_model
+        self._stop = threading.Event()
+        self._thread = None
+
+    def enqueue(self, recipient, subject, body):
+        message = self.message_model(recipient=recipient, subject=subject, body=body)
+        self.db.session.add(message)
+        return message
+
+    def notify(self, user_id, text):
+        # Events are coalesced into the user's next digest
+        event = self.event_model(user_id=user_id, text=text)
+        self.db.session.add(event)
+        return event
+
+    def build_digests(self):
+        Event, User = self.event_model, self.user_model
+        rows = self.db.session.execute(
+            self.db.select(Event, User.email)
+            .join(User, User.id == Event.user_id)
+            .where(Event.digested == False)
+            .order_by(Event.user_id, Event.created_at)
+        ).all()
+        if not rows:
+            return 0
+
+        pending = defaultdict(list)
+        for event, email in rows:
+            pending[email].append(event)
+        # Mark the events first; if another sender got to any of them, leave
+        # this round to it rather than sending the same activity twice
+        ids = [event.id for event, _ in rows]
+        marked = self.db.session.execute(
+            self.db.update(Event)
+            .where(Event.id.in_(ids), Event.digested == False)
+            .values(digested=True)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if marked != len(ids):
+            self.db.session.rollback()
+            return 0
+        for email, events in pending.items():
+            lines = [f'- {e.text}' for e in events]
+            self.enqueue(email, 'Your SharePay activity', 'Recent activity in your groups:\n\n' + '\n'.join(lines))
+        self.db.session.commit()
+        return len(pending)
+
+    def claim_batch(self, app):
+        """Lock up to MAIL_BATCH_SIZE due messages for this sender.
+
+        The conditional UPDATE only takes rows that are still unlocked, so
+        when several processes run the sender each message goes to exactly
+        one of them. A sender that dies mid-batch leaves its lock to expire
+        after MAIL_CLAIM_LEASE seconds, and the messages are picked up again.
+        """
+        Outbox = self.message_model
+        now = datetime.utcnow()
+        claimable = (Outbox.sent_at == None,
+                     Outbox.attempts < app.config['MAIL_MAX_ATTEMPTS'],
+                     Outbox.next_attempt_at <= now,
+                     self.db.or_(Outbox.locked_until == None, Outbox.locked_until <= now))
+        ids = self.db.session.execute(
+            self.db.select(Outbox.id).where(*claimable)
+            .order_by(Outbox.id)
+            .limit(app.config['MAIL_BATCH_SIZE'])
+        ).scalars().all()
+        if not ids:
+            self.db.session.rollback()
+            return []
+        token = uuid.uuid4().hex
+        self.db.session.execute(
+            self.db.update(Outbox)
+            .where(Outbox.id.in_(ids), *claimable)
+            .values(locked_until=now + timedelta(seconds=app.config['MAIL_CLAIM_LEASE']), locked_by=token)
+        )
+        self.db.session.commit()
+        return self.db.session.execute(
+            self.db.select(Outbox).where(Outbox.locked_by == token).order_by(Outbox.id)
+        ).scalars().all()
+
+    def send_pending(self, app):
+        """Deliver one batch of due messages and return how many were sent."""
+        now = datetime.utcnow()
+        batch = self.claim_batch(app)
+        if not batch:
+            return 0
+
+        sent = 0
+        try:
+            with self.mail.connect() as conn:
+                for message in batch:
+                    try:
+                        conn.send(Message(
+                            message.subject,
+                            sender=app.config['MAIL_DEFAULT_SENDER'],
+                            recipients=[message.recipient],
+                            body=message.body
+                        ))
+                    except Exception as exc:
+                        self._schedule_retry(app, message, exc)
+                    else:
+                        message.sent_at = datetime.utcnow()
+                        sent += 1
+        except Exception as exc:
+            # Could not connect (or the server dropped us): retry everything unsent
+            for message in batch:
+                if message.sent_at is None and message.next_attempt_at <= now:
+                    self._schedule_retry(app, message, exc)
+        for message in batch:
+            message.locked_until = message.locked_by = None
+        self.db.session.commit()
+        return sent
+
+    def _schedule_retry(self, app, message, exc):
+        message.attempts += 1
+        message.last_error = str(exc)[:500]
+        delay = app.config['MAIL_RETRY_BACKOFF'] * 2 ** (message.attempts - 1)
+        message.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+        log.warning('Mail to %s failed (attempt %d): %s', message.recipient, message.attempts, exc)
+
+    def run_once(self, app, build_digests=True):
+        with app.app_context():
+            if build_digests:
+                self.build_digests()
+            total = 0
+            while True:
+                sent = self.send_pending(app)
+                total += sent
+                if sent < app.config['MAIL_BATCH_SIZE']:
+                    return total
+
+    def run_forever(self, app):
+        last_digest = 0
+        while not self._stop.is_set():
+            due = time.monotonic() - last_digest >= app.config['NOTIFICATION_DIGEST_INTERVAL']
+            try:
+                self.run_once(app, build_digests=due)
+            except Exception:
+                log.exception('Mail sender iteration failed')
+            if due:
+                last_digest = time.monotonic()
+            self._stop.wait(app.config['MAIL_FLUSH_INTERVAL'])
+
+    def start(self, app):
+        """Start the sender on a daemon thread (one per process)."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run_forever, args=(app,), name='mail-sender', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
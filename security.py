@@ -0,0 +1,113 @@
+import hmac
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    """Runs bcrypt on a small, bounded thread pool.
+
+    bcrypt releases the GIL while hashing, so the pool caps how many cores
+    password work can take at once. At most workers + queue_size jobs are
+    accepted; beyond that HasherBusy is raised instead of queueing, so a
+    burst of logins cannot pile up behind the pool.
+    """
+
+    def __init__(self, bcrypt, app=None):
+        self.bcrypt = bcrypt
+        self.pool = None
+        self._slots = None
+        self._dummy_hash = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+        workers = app.config['PASSWORD_HASH_WORKERS']
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(workers + app.config['PASSWORD_HASH_QUEUE'])
+        self._dummy_hash = None
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy('Too many password operations in progress')
+        try:
+            future = self.pool.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future.result()
+
+    @property
+    def rounds(self):
+        # Read per call so a changed work factor applies without a restart
+        return current_app.config['BCRYPT_LOG_ROUNDS']
+
+    def hash(self, password):
+        return self._run(self.bcrypt.generate_password_hash, password, self.rounds).decode('utf-8')
+
+    def verify(self, stored, password):
+        if stored is None:
+            # Unknown account: spend the same time as a real check so the
+            # response does not reveal whether the username exists
+            if self._dummy_hash is None or bcrypt_cost(self._dummy_hash) != self.rounds:
+                self._dummy_hash = self.hash('not-a-real-password')
+            self._run(self.bcrypt.check_password_hash, self._dummy_hash, password)
+            return False
+        if not is_bcrypt_hash(stored):
+            # Accounts created before hashing was introduced store plaintext
+            return hmac.compare_digest(stored.encode('utf-8'), password.encode('utf-8'))
+        return self._run(self.bcrypt.check_password_hash, stored, password)
+
+    def needs_rehash(self, stored):
+        return not is_bcrypt_hash(stored) or bcrypt_cost(stored) != self.rounds
+
+
+def is_bcrypt_hash(value):
+    return value.startswith(('$2a$', '$2b$', '$2y$'))
+
+
+def bcrypt_cost(value):
+    # "$2b$12$<salt+hash>" -> 12
+    return int(value.split('$')[2])
+
+
+class TokenBucketLimiter:
+    """In-process token buckets keyed by e.g. client IP or account name.
+
+    Each key may spend `burst` attempts at once and regains `rate` attempts
+    per second. Only the `max_keys` most recently used buckets are kept.
+    """
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
@@ -0,0 +1,150 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import g
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+
+
+class ShardRouter:
+    """Routes group-owned tables to one of N SQLite databases by group_id.
+
+    With SHARD_COUNT set to 0 (the default) every call falls through to the
+    regular db.session, so the single app.db layout keeps working unchanged.
+    """
+
+    def __init__(self, db, tables, placement_model, app=None):
+        self.db = db
+        self.tables = list(tables)
+        # Model holding explicit group -> shard overrides written by rebalancing
+        self.placement_model = placement_model
+        self.engines = []
+        self.pool = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.dispose()
+        count = int(app.config.get('SHARD_COUNT') or 0)
+        template = app.config.get('SHARD_DATABASE_URI')
+        if count and not template:
+            os.makedirs(app.instance_path, exist_ok=True)
+            template = 'sqlite:///' + os.path.join(app.instance_path, 'shard_{shard}.db')
+        self.engines = [
+            create_engine(template.format(shard=shard), connect_args={'timeout': 30})
+            for shard in range(count)
+        ]
+        if count:
+            self.pool = ThreadPoolExecutor(max_workers=count, thread_name_prefix='shard')
+        if 'shard_router' not in app.extensions:
+            app.teardown_appcontext(self.close_sessions)
+        app.extensions['shard_router'] = self
+
+    @property
+    def enabled(self):
+        return len(self.engines) > 0
+
+    def dispose(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+        for engine in self.engines:
+            engine.dispose()
+        self.engines = []
+
+    def create_all(self):
+        for engine in self.engines:
+            self.db.metadata.create_all(engine, tables=[t.__table__ for t in self.tables])
+
+    def drop_all(self):
+        for engine in self.engines:
+            self.db.metadata.drop_all(engine, tables=[t.__table__ for t in self.tables])
+
+    def _placement(self, group_id):
+        # Always re-read: a move in another process must be visible here
+        return self.db.session.get(self.placement_model, group_id, populate_existing=True)
+
+    def shard_for(self, group_id):
+        group_id = int(group_id)
+        # Explicit placements win over the hash so moved groups stay reachable.
+        # This is a primary-key lookup and is not cached, so every worker sees
+        # a move as soon as it is committed.
+        placement = self._placement(group_id)
+        if placement is not None:
+            return placement.shard
+        return group_id % len(self.engines)
+
+    def commit(self, session, group_id):
+        """Commit writes for group_id made through session.
+
+        The flush takes the shard's write lock before the placement is checked
+        again, so a group being moved (or already moved) off this shard makes
+        the commit roll back instead of stranding rows on the old shard.
+        Returns False in that case; the caller should ask the client to retry.
+        """
+        if not self.enabled:
+            session.commit()
+            return True
+        session.flush()
+        group_id = int(group_id)
+        placement = self._placement(group_id)
+        current = placement.shard if placement is not None else group_id % len(self.engines)
+        if (placement is not None and placement.moving) or self.engines[current] is not session.bind:
+            session.rollback()
+            return False
+        session.commit()
+        return True
+
+    def session_for(self, group_id):
+        """Return the session that owns rows for group_id."""
+        if not self.enabled:
+            return self.db.session
+        return self.shard_session(self.shard_for(group_id))
+
+    def shard_session(self, shard):
+        # One session per shard per app context, closed on teardown
+        sessions = g.setdefault('shard_sessions', {})
+        if shard not in sessions:
+            sessions[shard] = Session(self.engines[shard])
+        return sessions[shard]
+
+    def close_sessions(self, exc=None):
+        for session in g.pop('shard_sessions', {}).values():
+            session.close()
+
+    def fan_out(self, query, group_of=None):
+        """Run query(session) on every shard in parallel and merge the results.
+
+        Each shard gets its own short-lived session on a pool thread; returned
+        ORM objects are detached but keep their loaded attributes.
+
+        While a group is being moved its rows exist on both shards for a
+        moment. Pass group_of(row) -> group_id to keep only rows from the
+        shard that currently owns the group; rows without a group are kept.
+        """
+        if not self.enabled:
+            return list(query(self.db.session))
+
+        def run(engine):
+            with Session(engine) as session:
+                return list(query(session))
+
+        results = list(self.pool.map(run, self.engines))
+        if group_of is None:
+            return [row for rows in results for row in rows]
+
+        # Read placements after the shards, so a move that finished meanwhile
+        # is seen and only its destination copy is kept
+        group_ids = {group_of(row) for rows in results for row in rows} - {None}
+        placements = dict(self.db.session.execute(
+            select(self.placement_model.group_id, self.placement_model.shard)
+            .where(self.placement_model.group_id.in_(group_ids))
+        ).all()) if group_ids else {}
+
+        def owned(shard, row):
+            group_id = group_of(row)
+            if group_id is None:
+                return True
+            return placements.get(group_id, group_id % len(self.engines)) == shard
+
+        return [row for shard, rows in enumerate(results) for row in rows if owned(shard, row)]
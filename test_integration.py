@@ -1,11 +1,20 @@
+import threading
 import unittest
-from app import app, db, User, Group, Expense, ExpenseSplit
+from unittest import mock
+
+import pytest
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import Session
+from datetime import date, datetime, timedelta
+from app import app, db, mail, outbox, rates, User, Group, Expense, ExpenseSplit, OutboxMessage, NotificationEvent
+from app import shard_router, move_group_to_shard, GroupShard, login_account_limiter, login_ip_limiter, IdempotencyKey
+from app import consistency_checker, idempotency_store, ExchangeRate, SCHEMA_UPGRADES, upgrade_database
+from migrations import upgrade_schema
+from debug_smtp import DebuggingSMTPServer
 from flask_bcrypt import Bcrypt
 
 class SharePayIntegrationTests(unittest.TestCase):
     def setUp(self):
-        app.config['TESTING'] = True
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
         app.config['WTF_CSRF_ENABLED'] = False 
         
         self.client = app.test_client()
@@ -13,11 +22,9 @@ class SharePayIntegrationTests(unittest.TestCase):
         self.app_context.push()
         
         self.bcrypt = Bcrypt(app)
-        db.create_all()
 
     def tearDown(self):
         db.session.remove()
-        db.drop_all()
         self.app_context.pop()
 
     def create_user(self, username, email, password):
@@ -160,5 +167,619 @@ class SharePayIntegrationTests(unittest.TestCase):
         john = User.query.filter_by(username='john').first()
         self.assertTrue(self.bcrypt.check_password_hash(john.password, 'oldpass'))
 
-if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+class ShardingIntegrationTests(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def use_fixtures(self, monkeypatch, tmp_path, client, users, make_group, login_as, add_expense):
+        monkeypatch.setitem(app.config, 'SHARD_COUNT', 2)
+        monkeypatch.setitem(app.config, 'SHARD_DATABASE_URI', 'sqlite:///' + str(tmp_path / 'shard_{shard}.db'))
+        shard_router.init_app(app)
+        shard_router.create_all()
+        self.client = client
+        self.add_expense = add_expense
+        self.alice, self.bob = users.alice, users.bob
+        # Consecutive group ids hash to different shards
+        self.trip = make_group('Trip', [self.alice, self.bob])
+        self.flat = make_group('Flat', [self.alice, self.bob])
+        login_as(self.bob)
+        yield
+        shard_router.close_sessions()
+        monkeypatch.undo()
+        shard_router.init_app(app)
+
+    def shard_rows(self, shard, model):
+        return shard_router.shard_session(shard).execute(db.select(model)).scalars().all()
+
+    def test_expenses_are_routed_by_group(self):
+        self.add_expense('Trip', 'Dinner', '100')
+        self.add_expense('Flat', 'Taxi', '30')
+
+        for group, description in ((self.trip, 'Dinner'), (self.flat, 'Taxi')):
+            shard = shard_router.shard_for(group.id)
+            expenses = self.shard_rows(shard, Expense)
+            self.assertEqual([e.description for e in expenses], [description])
+            splits = self.shard_rows(shard, ExpenseSplit)
+            self.assertEqual([s.user_id for s in splits], [self.bob.id])
+        # Nothing is written to the main database
+        self.assertEqual(Expense.query.count(), 0)
+
+    def test_dashboard_fans_out_and_settle_uses_group(self):
+        self.add_expense('Trip', 'Dinner', '100')
+        self.add_expense('Flat', 'Taxi', '30')
+
+        resp = self.client.get('/dashboard')
+        self.assertIn(b'Dinner', resp.data)
+        self.assertIn(b'Taxi', resp.data)
+
+        shard = shard_router.shard_for(self.flat.id)
+        split = self.shard_rows(shard, ExpenseSplit)[0]
+        resp = self.client.post('/settle_split', data=dict(split_id=split.id))
+        self.assertEqual(resp.status_code, 400)
+        self.client.post('/settle_split', data=dict(split_id=split.id, group_id=self.flat.id))
+        shard_router.close_sessions()
+        self.assertTrue(self.shard_rows(shard, ExpenseSplit)[0].is_settled)
+
+    def test_move_group_to_other_shard(self):
+        self.add_expense('Trip', 'Dinner', '100')
+        source = shard_router.shard_for(self.trip.id)
+        dest = 1 - source
+
+        self.assertEqual(move_group_to_shard(self.trip.id, dest), 1)
+        shard_router.close_sessions()
+
+        self.assertEqual(shard_router.shard_for(self.trip.id), dest)
+        self.assertEqual(self.shard_rows(source, Expense), [])
+        self.assertEqual(self.shard_rows(source, ExpenseSplit), [])
+        moved = self.shard_rows(dest, Expense)
+        self.assertEqual([e.description for e in moved], ['Dinner'])
+        split = self.shard_rows(dest, ExpenseSplit)[0]
+        self.assertEqual(split.expense_id, moved[0].id)
+
+        resp = self.client.get('/dashboard')
+        self.assertIn(b'Dinner', resp.data)
+
+    def test_dashboard_shows_moving_group_once(self):
+        self.add_expense('Trip', 'Dinner', '100')
+        before = self.client.get('/dashboard').data.count(b'Dinner')
+        source = shard_router.shard_for(self.trip.id)
+        dest = 1 - source
+        # A move midway: the rows are copied to dest but not yet deleted
+        # from source, first with the group still placed on source...
+        dst = shard_router.shard_session(dest)
+        copy = Expense(description='Dinner', amount=100.0, payer_id=self.alice.id, group_id=self.trip.id)
+        dst.add(copy)
+        dst.flush()
+        dst.add(ExpenseSplit(expense_id=copy.id, user_id=self.bob.id, amount=50.0))
+        dst.commit()
+        db.session.add(GroupShard(group_id=self.trip.id, shard=source, moving=True))
+        db.session.commit()
+        self.assertEqual(self.client.get('/dashboard').data.count(b'Dinner'), before)
+
+        # ...then placed on dest
+        db.session.merge(GroupShard(group_id=self.trip.id, shard=dest, moving=False))
+        db.session.commit()
+        resp = self.client.get('/dashboard')
+        self.assertEqual(resp.data.count(b'Dinner'), before)
+        self.assertEqual(len(self.shard_rows(source, Expense)), 1)
+
+    def test_writer_racing_a_move_is_refused(self):
+        source = shard_router.shard_for(self.trip.id)
+        # A writer routed to the source shard before the move started...
+        with Session(shard_router.engines[source]) as writer:
+            writer.add(Expense(description='Late', amount=10.0, payer_id=self.alice.id, group_id=self.trip.id))
+            move_group_to_shard(self.trip.id, 1 - source)
+            # ...cannot commit there afterwards, so nothing is stranded
+            self.assertFalse(shard_router.commit(writer, self.trip.id))
+        shard_router.close_sessions()
+        self.assertEqual(self.shard_rows(source, Expense), [])
+
+    def test_writes_are_refused_while_group_is_moving(self):
+        db.session.add(GroupShard(group_id=self.trip.id, shard=shard_router.shard_for(self.trip.id), moving=True))
+        db.session.commit()
+        resp = self.add_expense('Trip', 'Dinner', '100')
+        self.assertEqual(resp.status_code, 503)
+        shard_router.close_sessions()
+        self.assertEqual(self.shard_rows(shard_router.shard_for(self.trip.id), Expense), [])
+
+
+class OutboxIntegrationTests(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def use_fixtures(self, monkeypatch, client, users, make_group, add_expense):
+        self.smtp = DebuggingSMTPServer().start()
+        monkeypatch.setitem(app.config, 'MAIL_SERVER', '127.0.0.1')
+        monkeypatch.setitem(app.config, 'MAIL_PORT', self.smtp.port)
+        monkeypatch.setitem(app.config, 'MAIL_SUPPRESS_SEND', False)
+        mail.init_app(app)
+        self.monkeypatch = monkeypatch
+        self.client = client
+        self.add_expense = add_expense
+        self.alice, self.bob, self.carol = users.alice, users.bob, users.carol
+        make_group('Trip', [self.alice, self.bob, self.carol])
+        yield
+        self.smtp.stop()
+        monkeypatch.undo()
+        mail.init_app(app)
+
+    def test_forget_password_only_queues_mail(self):
+        resp = self.client.post('/forget_password', data=dict(email='bob@example.com'))
+        self.assertIn(b'reset your password', resp.data)
+        self.assertEqual(self.smtp.messages, [])
+        queued = OutboxMessage.query.one()
+        self.assertEqual(queued.recipient, 'bob@example.com')
+        self.assertIsNone(queued.sent_at)
+
+    def test_events_coalesce_into_digests_sent_over_one_connection(self):
+        self.add_expense('Trip', 'Dinner', '90')
+        self.add_expense('Trip', 'Taxi', '30')
+        self.assertEqual(NotificationEvent.query.count(), 4)
+        self.assertEqual(self.smtp.messages, [])
+
+        self.assertEqual(outbox.run_once(app), 2)
+        self.assertEqual(self.smtp.connections, 1)
+        recipients = sorted(rcpt[0] for _, rcpt, _ in self.smtp.messages)
+        self.assertEqual(recipients, ['bob@example.com', 'carol@example.com'])
+        body = self.smtp.messages[0][2].get_payload(decode=True).decode()
+        self.assertIn('Dinner', body)
+        self.assertIn('Taxi', body)
+
+        # Everything is marked done, so a second pass sends nothing
+        self.assertEqual(outbox.run_once(app), 0)
+        self.assertEqual(len(self.smtp.messages), 2)
+
+    def test_failed_delivery_is_retried_with_backoff(self):
+        outbox.enqueue('bob@example.com', 'Hello', 'body')
+        db.session.commit()
+        # Nothing listens on the old port once the server is gone
+        self.smtp.stop()
+
+        self.assertEqual(outbox.send_pending(app), 0)
+        queued = OutboxMessage.query.one()
+        self.assertEqual(queued.attempts, 1)
+        self.assertIsNotNone(queued.last_error)
+        self.assertGreater(queued.next_attempt_at, datetime.utcnow())
+        # Not due yet, so nothing is attempted
+        self.assertEqual(outbox.send_pending(app), 0)
+        self.assertEqual(OutboxMessage.query.one().attempts, 1)
+
+        self.smtp = DebuggingSMTPServer().start()
+        self.monkeypatch.setitem(app.config, 'MAIL_PORT', self.smtp.port)
+        mail.init_app(app)
+        queued.next_attempt_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(outbox.send_pending(app), 1)
+        self.assertIsNotNone(OutboxMessage.query.one().sent_at)
+        self.assertEqual(len(self.smtp.messages), 1)
+
+    def test_claimed_messages_are_not_sent_twice(self):
+        for i in range(3):
+            outbox.enqueue('bob@example.com', f'Hello {i}', 'body')
+        db.session.commit()
+        # Another sender has claimed the batch and not finished yet
+        self.assertEqual(len(outbox.claim_batch(app)), 3)
+        self.assertEqual(outbox.claim_batch(app), [])
+        self.assertEqual(outbox.send_pending(app), 0)
+        self.assertEqual(self.smtp.messages, [])
+
+        # Its lease runs out, e.g. because it crashed, and the mail goes out once
+        OutboxMessage.query.update({OutboxMessage.locked_until: datetime.utcnow()})
+        db.session.commit()
+        self.assertEqual(outbox.send_pending(app), 3)
+        self.assertEqual(outbox.send_pending(app), 0)
+        self.assertEqual(len(self.smtp.messages), 3)
+        self.assertIsNone(OutboxMessage.query.first().locked_until)
+
+    def test_concurrent_senders_deliver_each_message_once(self):
+        self.monkeypatch.setitem(app.config, 'MAIL_BATCH_SIZE', 4)
+        for i in range(20):
+            outbox.enqueue('bob@example.com', f'Hello {i}', 'body')
+        db.session.commit()
+
+        senders = [threading.Thread(target=outbox.run_once, args=(app, False)) for _ in range(4)]
+        for t in senders:
+            t.start()
+        for t in senders:
+            t.join()
+        subjects = sorted(m['Subject'] for _, _, m in self.smtp.messages)
+        self.assertEqual(subjects, sorted(f'Hello {i}' for i in range(20)))
+
+
+class CurrencyIntegrationTests(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def use_fixtures(self, tmp_path, client, users, make_group, add_expense):
+        # Rates are units per USD; the CSV is loaded through the bulk importer
+        path = tmp_path / 'rates.csv'
+        path.write_text('date,currency,rate\n2024-06-03,EUR,0.5\n2024-06-03,GBP,0.25\n2024-06-10,EUR,0.8\n')
+        self.assertEqual(rates.import_csv(path), 3)
+        self.client = client
+        self.add_expense = add_expense
+        self.alice, self.bob = users.alice, users.bob
+        self.group = make_group('Europe', [self.alice, self.bob], base_currency='GBP')
+        yield
+        rates.cache_clear()
+
+    def test_conversion_is_stored_at_write_time(self):
+        # 100 EUR at 0.5/USD is 200 USD, which is 50 GBP at 0.25/USD.
+        # Friday's rate covers the weekend.
+        self.add_expense('Europe', 'Museum', '100', currency='eur', date='2024-06-08')
+        expense = Expense.query.one()
+        self.assertEqual(expense.currency, 'EUR')
+        self.assertAlmostEqual(expense.base_amount, 50.0)
+        split = ExpenseSplit.query.one()
+        self.assertAlmostEqual(split.amount, 50.0)
+        self.assertAlmostEqual(split.base_amount, 25.0)
+
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = self.bob.id
+            sess['username'] = 'bob'
+        resp = self.client.get('/dashboard')
+        self.assertIn(b'Your balance: -25.00 GBP', resp.data)
+        self.assertIn(b'50.00 EUR', resp.data)
+
+    def test_rate_lookups_are_cached(self):
+        rates.cache_clear()
+        self.add_expense('Europe', 'Museum', '10', currency='EUR', date='2024-06-04')
+        self.add_expense('Europe', 'Museum', '10', currency='EUR', date='2024-06-04')
+        info = rates.cache_info()
+        self.assertEqual(info.misses, 2)
+        self.assertEqual(info.hits, 2)
+        # Later rates apply from their own date on
+        self.assertAlmostEqual(rates.convert(8, 'EUR', 'USD', date(2024, 6, 11)), 10.0)
+
+    def test_misses_and_today_are_not_cached(self):
+        self.assertIsNone(rates.rate('JPY', date(2024, 6, 4)))
+        self.assertIsNone(rates.rate('JPY', date.today()))
+        # Rates written by another process (not through import_csv) show up
+        db.session.add(ExchangeRate(currency='JPY', date=date(2024, 6, 3), rate=150.0))
+        db.session.add(ExchangeRate(currency='CHF', date=date.today(), rate=0.9))
+        db.session.commit()
+        self.assertEqual(rates.rate('JPY', date(2024, 6, 4)), 150.0)
+        self.assertEqual(rates.rate('CHF', date.today()), 0.9)
+        db.session.query(ExchangeRate).filter_by(currency='CHF').update({'rate': 0.95})
+        db.session.commit()
+        self.assertEqual(rates.rate('CHF', date.today()), 0.95)
+
+    def test_rate_written_elsewhere_replaces_cached_rate(self):
+        # Friday's rate is cached for Saturday...
+        self.assertEqual(rates.rate('EUR', date(2024, 6, 8)), 0.5)
+        self.assertEqual(rates.rate('EUR', date(2024, 6, 8)), 0.5)
+        # ...until another process stores a rate closer to that day
+        db.session.add(ExchangeRate(currency='EUR', date=date(2024, 6, 7), rate=0.6))
+        db.session.commit()
+        self.assertEqual(rates.rate('EUR', date(2024, 6, 8)), 0.6)
+        # Corrections to an existing rate invalidate it too
+        db.session.execute(db.update(ExchangeRate).where(ExchangeRate.date == date(2024, 6, 7)).values(rate=0.65))
+        db.session.commit()
+        self.assertEqual(rates.rate('EUR', date(2024, 6, 8)), 0.65)
+
+    def test_invalid_currency_codes_are_rejected(self):
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = self.alice.id
+            sess['username'] = 'alice'
+        for code in ('EURO', 'E1R', 'us'):
+            self.assertEqual(self.add_expense('Europe', 'Museum', '10', currency=code, date='2024-06-04').status_code, 400)
+        self.assertEqual(Expense.query.count(), 0)
+        resp = self.client.post('/create_group', data=dict(group_name='Bad', base_currency='DOLLARS'))
+        self.assertEqual(resp.status_code, 400)
+        self.assertIsNone(Group.query.filter_by(name='Bad').first())
+
+        self.add_expense('Europe', 'Museum', '10', currency='EUR', date='2024-06-04')
+        expense = Expense.query.one()
+        resp = self.client.post('/edit_expense', data=dict(expense_id=expense.id, currency='€'))
+        self.assertEqual(resp.status_code, 400)
+        db.session.expire_all()
+        self.assertEqual(Expense.query.one().currency, 'EUR')
+
+    def test_missing_rate_rejects_expense(self):
+        resp = self.add_expense('Europe', 'Museum', '10', currency='JPY', date='2024-06-04')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn(b'No exchange rate for JPY', resp.data)
+        self.assertEqual(Expense.query.count(), 0)
+
+
+class LoginIntegrationTests(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def use_fixtures(self, monkeypatch, app_context, client):
+        monkeypatch.setitem(app.config, 'BCRYPT_LOG_ROUNDS', 4)
+        self.monkeypatch = monkeypatch
+        self.client = client
+        yield
+        login_account_limiter.burst, login_account_limiter.rate = app.config['LOGIN_ACCOUNT_BURST'], app.config['LOGIN_ACCOUNT_RATE']
+        login_account_limiter.reset()
+        login_ip_limiter.reset()
+
+    def login(self, username, password):
+        return self.client.post('/login', data=dict(username=username, password=password))
+
+    def test_register_stores_hash_and_login_checks_it(self):
+        self.client.post('/register', data=dict(username='alice', email='alice@example.com', password='secret'))
+        stored = User.query.filter_by(username='alice').one().password
+        self.assertTrue(stored.startswith('$2b$04$'))
+
+        self.client.get('/logout')
+        self.assertEqual(self.login('alice', 'secret').status_code, 302)
+        self.assertIn(b'Invalid credentials', self.login('alice', 'wrong').data)
+        self.assertIn(b'Invalid credentials', self.login('nobody', 'secret').data)
+
+    def test_login_rehashes_when_work_factor_changes(self):
+        self.client.post('/register', data=dict(username='alice', email='alice@example.com', password='secret'))
+        self.monkeypatch.setitem(app.config, 'BCRYPT_LOG_ROUNDS', 5)
+
+        self.assertEqual(self.login('alice', 'secret').status_code, 302)
+        db.session.expire_all()
+        self.assertTrue(User.query.filter_by(username='alice').one().password.startswith('$2b$05$'))
+
+    def test_legacy_plaintext_password_is_upgraded(self):
+        db.session.add(User(username='bob', email='bob@example.com', password='plain'))
+        db.session.commit()
+
+        self.assertEqual(self.login('bob', 'plain').status_code, 302)
+        db.session.expire_all()
+        self.assertTrue(User.query.filter_by(username='bob').one().password.startswith('$2b$04$'))
+
+    def test_account_burst_is_rejected_before_checking_password(self):
+        self.client.post('/register', data=dict(username='alice', email='alice@example.com', password='secret'))
+        login_account_limiter.burst, login_account_limiter.rate = 2, 0
+        login_account_limiter.reset()
+
+        self.assertIn(b'Invalid credentials', self.login('alice', 'wrong').data)
+        self.assertIn(b'Invalid credentials', self.login('Alice', 'wrong').data)
+        # Even the right password is refused once the bucket is empty
+        self.assertEqual(self.login('alice', 'secret').status_code, 429)
+
+
+class IdempotencyIntegrationTests(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def use_fixtures(self, client, users, make_group, login_as, add_expense):
+        self.client = client
+        self.add_expense = add_expense
+        self.alice, self.bob = users.alice, users.bob
+        make_group('Trip', [self.alice, self.bob])
+        login_as(self.bob)
+
+    def test_retry_replays_response_without_new_rows(self):
+        first = self.add_expense('Trip', 'Dinner', '100', key='k1')
+        retry = self.add_expense('Trip', 'Dinner', '100', key='k1')
+        self.assertEqual(retry.status_code, first.status_code)
+        self.assertEqual(retry.headers['Location'], first.headers['Location'])
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        self.assertEqual(Expense.query.count(), 1)
+        self.assertEqual(ExpenseSplit.query.count(), 1)
+
+        # A new key is a new request
+        self.add_expense('Trip', 'Dinner', '100', key='k2')
+        self.assertEqual(Expense.query.count(), 2)
+
+    def test_settle_split_retry(self):
+        self.add_expense('Trip', 'Dinner', '100', key='k1')
+        split = ExpenseSplit.query.one()
+        for _ in range(2):
+            resp = self.client.post('/settle_split', data=dict(split_id=split.id), headers={'Idempotency-Key': 'settle'})
+            self.assertEqual(resp.status_code, 302)
+        # Only the first settle notified the payer
+        self.assertEqual(NotificationEvent.query.filter_by(user_id=self.alice.id).count(), 1)
+
+    def test_key_reused_for_different_request(self):
+        self.add_expense('Trip', 'Dinner', '100', key='k1')
+        resp = self.add_expense('Trip', 'Dinner', '50', key='k1')
+        self.assertEqual(resp.status_code, 422)
+        self.assertEqual(Expense.query.count(), 1)
+
+    def test_in_progress_and_expired_keys(self):
+        self.add_expense('Trip', 'Dinner', '100', key='k1')
+        row = IdempotencyKey.query.one()
+        row.status_code = None
+        db.session.commit()
+        self.assertEqual(self.add_expense('Trip', 'Dinner', '100', key='k1').status_code, 409)
+
+        row.expires_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        self.assertEqual(self.add_expense('Trip', 'Dinner', '100', key='k1').status_code, 302)
+        self.assertEqual(Expense.query.count(), 2)
+        self.assertEqual(IdempotencyKey.query.count(), 1)
+
+    def test_failure_after_handler_commit_keeps_nothing(self):
+        # The handler has committed; storing its response then fails
+        with mock.patch.object(idempotency_store, '_store_response', side_effect=RuntimeError('disk I/O error')):
+            with self.assertRaises(RuntimeError):
+                self.add_expense('Trip', 'Dinner', '100', key='k1')
+        # The expense was committed together with the response, so neither exists
+        self.assertEqual(Expense.query.count(), 0)
+        self.assertEqual(NotificationEvent.query.count(), 0)
+        self.assertIsNone(IdempotencyKey.query.one().status_code)
+
+        # Within the lease the first request might still be running
+        self.assertEqual(self.add_expense('Trip', 'Dinner', '100', key='k1').status_code, 409)
+        row = IdempotencyKey.query.one()
+        row.claimed_at -= timedelta(seconds=app.config['IDEMPOTENCY_CLAIM_LEASE'] + 1)
+        db.session.commit()
+        self.assertEqual(self.add_expense('Trip', 'Dinner', '100', key='k1').status_code, 302)
+        self.assertEqual(self.add_expense('Trip', 'Dinner', '100', key='k1').headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(Expense.query.count(), 1)
+
+    def test_expired_key_is_taken_over_once(self):
+        self.add_expense('Trip', 'Dinner', '100', key='k1')
+        row = IdempotencyKey.query.one()
+        row.expires_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        ttl, lease = timedelta(hours=1), timedelta(minutes=1)
+        fingerprint = b'x' * 16
+        _, first = idempotency_store.claim(self.bob.id, 'k1', fingerprint, ttl, lease)
+        _, second = idempotency_store.claim(self.bob.id, 'k1', fingerprint, ttl, lease)
+        self.assertIsNone(first)
+        self.assertIsNotNone(second)
+        self.assertIsNone(second.status_code)
+
+    def test_anonymous_callers_do_not_share_keys(self):
+        for address in ('10.0.0.1', '10.0.0.2'):
+            resp = app.test_client().post('/add_expense', data=dict(
+                group_name_expense='Trip', description='Dinner', amount='100', paid_by='alice@example.com'
+            ), headers={'Idempotency-Key': 'k1'}, environ_base={'REMOTE_ADDR': address})
+            self.assertNotIn('Idempotent-Replayed', resp.headers)
+        self.assertEqual(Expense.query.count(), 2)
+
+    def test_registration_retry_is_replayed(self):
+        anonymous = app.test_client()
+        form = dict(username='dave', email='dave@example.com', password='secret')
+        first = anonymous.post('/register', data=form, headers={'Idempotency-Key': 'reg'})
+        # The first response was lost, so the retry carries no session cookie
+        retry = app.test_client().post('/register', data=form, headers={'Idempotency-Key': 'reg'})
+        self.assertEqual(retry.status_code, first.status_code)
+        self.assertEqual(retry.headers['Location'], first.headers['Location'])
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        # The login cookie is not replayed
+        self.assertNotIn('Set-Cookie', retry.headers)
+        self.assertEqual(User.query.filter_by(username='dave').count(), 1)
+
+    def test_client_errors_are_replayed(self):
+        resp = self.client.post('/add_expense', data=dict(group_name_expense='Nope', amount='1'),
+                                headers={'Idempotency-Key': 'k1'})
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(IdempotencyKey.query.one().status_code, 404)
+        resp = self.client.post('/add_expense', data=dict(group_name_expense='Nope', amount='1'),
+                                headers={'Idempotency-Key': 'k1'})
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.headers['Idempotent-Replayed'], 'true')
+
+
+class ConsistencyIntegrationTests(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def use_fixtures(self, monkeypatch, client, users, make_group, login_as, add_expense):
+        monkeypatch.setitem(app.config, 'CONSISTENCY_OVERLAP', 0)
+        monkeypatch.setitem(app.config, 'CONSISTENCY_PAUSE', 0)
+        self.monkeypatch = monkeypatch
+        self.client = client
+        self.login_as = login_as
+        self.alice, self.bob, self.carol = users.alice, users.bob, users.carol
+        make_group('Trip', [self.alice, self.bob, self.carol])
+
+        add_expense('Trip', 'Dinner', '90')
+        self.assertEqual(consistency_checker.run(app, full=True), [])
+
+    def split_of(self, user):
+        return ExpenseSplit.query.filter_by(user_id=user.id).first()
+
+    def test_ex_member_split_is_reported_and_repaired(self):
+        self.login_as(self.carol)
+        self.client.post('/leave_group', data=dict(group_id=Group.query.one().id))
+
+        violations = consistency_checker.run(app, repair=True)
+        self.assertEqual([v.kind for v in violations], ['ex_member_split'])
+        db.session.expire_all()
+        self.assertIsNone(self.split_of(self.carol))
+        # The payer and bob now share the expense
+        self.assertAlmostEqual(self.split_of(self.bob).amount, 45.0)
+        self.assertEqual(consistency_checker.run(app, full=True), [])
+
+    def test_repair_keeps_share_of_payer_who_left(self):
+        group_id = Group.query.one().id
+        for user in (self.carol, self.alice):
+            self.login_as(user)
+            self.client.post('/leave_group', data=dict(group_id=group_id))
+
+        violations = consistency_checker.run(app, repair=True)
+        self.assertEqual([v.kind for v in violations], ['ex_member_split'])
+        db.session.expire_all()
+        # alice still paid her own share; only carol's is redistributed
+        self.assertAlmostEqual(self.split_of(self.bob).amount, 45.0)
+
+    def test_only_changed_rows_are_scanned(self):
+        # A bad split whose updated_at predates the checkpoint is not rescanned
+        db.session.execute(db.update(ExpenseSplit).where(ExpenseSplit.user_id == self.bob.id)
+                           .values(amount=10.0, updated_at=datetime(2000, 1, 1)))
+        db.session.commit()
+        self.assertEqual(consistency_checker.run(app), [])
+
+        violations = consistency_checker.run(app, full=True)
+        self.assertEqual([v.kind for v in violations], ['split_total'])
+
+        # A normal write to the split makes it a candidate again
+        self.split_of(self.bob).receipt_image = 'r.png'
+        db.session.commit()
+        self.assertEqual([v.kind for v in consistency_checker.run(app)], ['split_total'])
+
+    def test_settled_expenses_are_reported_not_repaired(self):
+        split = self.split_of(self.bob)
+        split.amount = 10.0
+        split.is_settled = True
+        db.session.commit()
+
+        violations = consistency_checker.run(app, repair=True)
+        self.assertEqual([v.kind for v in violations], ['split_total'])
+        db.session.expire_all()
+        self.assertAlmostEqual(self.split_of(self.bob).amount, 10.0)
+
+    def test_batch_lookups_use_indexes(self):
+        # A full scan here would make every batch, and so a full pass, quadratic
+        for sql in ('SELECT id FROM expense_split WHERE expense_id IN (1, 2)',
+                    'SELECT id FROM expense WHERE group_id IN (1, 2)'):
+            plan = ' '.join(row[-1] for row in db.session.execute(db.text('EXPLAIN QUERY PLAN ' + sql)))
+            self.assertIn('USING', plan, sql)
+            self.assertNotIn('SCAN', plan, sql)
+
+    def test_loop_survives_failed_pass_and_honours_full(self):
+        calls = []
+
+        def run(app, repair=False, full=False):
+            calls.append(full)
+            if len(calls) == 1:
+                raise RuntimeError('database is locked')
+            if len(calls) == 3:
+                raise KeyboardInterrupt
+
+        self.monkeypatch.setitem(app.config, 'CONSISTENCY_CHECK_INTERVAL', 0)
+        with mock.patch.object(consistency_checker, 'run', side_effect=run), mock.patch('consistency.os.nice'):
+            with self.assertLogs('consistency', 'ERROR'):
+                with self.assertRaises(KeyboardInterrupt):
+                    consistency_checker.run_forever(app, full=True)
+        self.assertEqual(calls, [True, True, True])
+
+
+class SchemaUpgradeIntegrationTests(unittest.TestCase):
+    # Tables as an older release created them
+    OLD_SCHEMA = [
+        'CREATE TABLE "group" (id INTEGER PRIMARY KEY, name VARCHAR(200) NOT NULL UNIQUE, tag VARCHAR(200) UNIQUE)',
+        'CREATE TABLE expense (id INTEGER PRIMARY KEY, description VARCHAR(500) NOT NULL, amount FLOAT NOT NULL, '
+        'date DATETIME, location VARCHAR(300), receipt_image VARCHAR(300), payer_id INTEGER NOT NULL, '
+        'group_id INTEGER NOT NULL)',
+        'CREATE TABLE expense_split (id INTEGER PRIMARY KEY, expense_id INTEGER NOT NULL, user_id INTEGER NOT NULL, '
+        'amount FLOAT NOT NULL, is_settled BOOLEAN, receipt_image VARCHAR(300))',
+        "INSERT INTO \"group\" (id, name, tag) VALUES (1, 'Trip', 'trip-1')",
+        "INSERT INTO expense (id, description, amount, date, payer_id, group_id) "
+        "VALUES (1, 'Dinner', 90.0, '2024-06-03 19:00:00', 1, 1)",
+        'INSERT INTO expense_split (id, expense_id, user_id, amount, is_settled) VALUES (1, 1, 2, 45.0, 0)',
+    ]
+
+    @pytest.fixture(autouse=True)
+    def use_fixtures(self, tmp_path):
+        self.engine = create_engine('sqlite:///' + str(tmp_path / 'old.db'))
+        with self.engine.begin() as conn:
+            for statement in self.OLD_SCHEMA:
+                conn.exec_driver_sql(statement)
+        yield
+        self.engine.dispose()
+
+    def test_old_database_is_upgraded_and_backfilled(self):
+        added = upgrade_schema(self.engine, SCHEMA_UPGRADES)
+        self.assertIn('expense.base_amount', added)
+        self.assertIn('ix_expense_split_expense_id', added)
+        self.assertIn('ix_expense_group_id', added)
+        # Every model column now exists, so the ORM can load old rows
+        inspector = inspect(self.engine)
+        for model in (Group, Expense, ExpenseSplit):
+            table = model.__table__
+            self.assertEqual({c['name'] for c in inspector.get_columns(table.name)}, set(table.columns.keys()))
+        with Session(self.engine) as sess:
+            # Old rows look freshly changed, so the next incremental check covers them
+            self.assertGreater(sess.get(Expense, 1).updated_at, datetime.utcnow() - timedelta(minutes=1))
+            self.assertIsNotNone(sess.get(ExpenseSplit, 1).updated_at)
+        with self.engine.connect() as conn:
+            self.assertEqual(conn.exec_driver_sql('SELECT base_currency FROM "group"').scalar(), 'USD')
+            self.assertIsNotNone(conn.exec_driver_sql('SELECT members_changed_at FROM "group"').scalar())
+            self.assertEqual(conn.exec_driver_sql('SELECT currency, base_amount FROM expense').one(), ('USD', 90.0))
+            self.assertEqual(conn.exec_driver_sql('SELECT base_amount FROM expense_split').scalar(), 45.0)
+        # A second run has nothing left to do
+        self.assertEqual(upgrade_schema(self.engine, SCHEMA_UPGRADES), [])
+
+    def test_current_schema_needs_no_upgrade(self):
+        with app.app_context():
+            self.assertEqual(upgrade_database(), [])
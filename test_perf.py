@@ -0,0 +1,65 @@
+import time
+import unittest
+
+import pytest
+
+from app import app, db, consistency_checker, User, Expense, ExpenseSplit
+
+
+@pytest.mark.perf
+class SharePayPerfSmokeTests(unittest.TestCase):
+    """Coarse time budgets that catch accidental N+1 queries or O(n^2) loops.
+
+    The limits are several times what a laptop needs, so they only fail on
+    real regressions; run with -m "not perf" to skip them.
+    """
+
+    EXPENSES = 1000
+
+    @pytest.fixture(autouse=True)
+    def use_fixtures(self, monkeypatch, client, app_context, make_group):
+        monkeypatch.setitem(app.config, 'CONSISTENCY_PAUSE', 0)
+        self.client = client
+        self.users = [User(username=f'user{i}', email=f'user{i}@example.com', password='pw') for i in range(5)]
+        self.group = make_group('Flat', self.users)
+
+    def seed_expenses(self):
+        payer = self.users[0]
+        expenses = [Expense(description=f'Item {i}', amount=50.0, base_amount=50.0, payer_id=payer.id,
+                            group_id=self.group.id) for i in range(self.EXPENSES)]
+        db.session.add_all(expenses)
+        db.session.flush()
+        db.session.add_all([ExpenseSplit(expense_id=e.id, user_id=u.id, amount=10.0, base_amount=10.0)
+                            for e in expenses for u in self.users[1:]])
+        db.session.commit()
+
+    def assertFasterThan(self, seconds, fn):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        self.assertLess(elapsed, seconds, f'took {elapsed:.2f}s, budget {seconds}s')
+
+    def test_dashboard_with_many_expenses(self):
+        self.seed_expenses()
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = self.users[1].id
+            sess['username'] = 'user1'
+
+        def render():
+            resp = self.client.get('/dashboard')
+            self.assertEqual(resp.status_code, 200)
+        self.assertFasterThan(5.0, render)
+
+    def test_add_expense_throughput(self):
+        def add_many():
+            for i in range(100):
+                resp = self.client.post('/add_expense', data=dict(
+                    group_name_expense='Flat', description=f'Item {i}', amount='25', paid_by='user0@example.com'
+                ))
+                self.assertEqual(resp.status_code, 302)
+        self.assertFasterThan(5.0, add_many)
+        self.assertEqual(ExpenseSplit.query.count(), 400)
+
+    def test_full_consistency_check(self):
+        self.seed_expenses()
+        self.assertFasterThan(5.0, lambda: self.assertEqual(consistency_checker.run(app, full=True), []))